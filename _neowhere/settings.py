@@ -131,3 +131,71 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static/')
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
+
+
+# Cache of parsed MPC uncertainty maps, set directory to None to disable.
+# Requests for the same object and observatory within JD_BUCKET days share
+# an entry, so keep the bucket short, NEOs move several arcseconds a minute.
+UNCERTAINTYMAP_CACHE_DIR = os.path.join(BASE_DIR, 'cache/')
+UNCERTAINTYMAP_CACHE_TTL = 10 * 60  # seconds
+UNCERTAINTYMAP_CACHE_MAX_SIZE = 256 * 1024 * 1024  # bytes
+UNCERTAINTYMAP_CACHE_JD_BUCKET = 2 / (24 * 60)  # days
+
+# HTTP connections to minorplanetcenter.net, shared by all requests:
+UNCERTAINTYMAP_HTTP_POOL_SIZE = 10  # connections kept alive
+UNCERTAINTYMAP_HTTP_RETRIES = 3
+UNCERTAINTYMAP_HTTP_BACKOFF = 0.5  # seconds, doubled on every retry
+UNCERTAINTYMAP_HTTP_TIMEOUT = 10, 60  # seconds, to connect and to read
+
+# Generate images in background jobs on a process pool, instead of inside
+# the request. Job state is kept in JOBS_DIR for JOBS_KEEP seconds.
+UNCERTAINTYMAP_ASYNC_JOBS = True
+UNCERTAINTYMAP_JOB_WORKERS = 2
+# How workers are started, see multiprocessing start methods. Forking a
+# threaded web server may copy locks held by its other threads.
+UNCERTAINTYMAP_JOB_START_METHOD = 'forkserver'
+UNCERTAINTYMAP_JOBS_DIR = os.path.join(BASE_DIR, 'jobs/')
+UNCERTAINTYMAP_JOBS_KEEP = 24 * 60 * 60
+
+# Maps are parsed while they download, in chunks of this many bytes:
+UNCERTAINTYMAP_HTTP_CHUNK_SIZE = 64 * 1024
+# Ephemeris of a variant this close (in arcseconds) to the nominal orbit is
+# requested while the rest of the map downloads. With 0, only the nominal
+# orbit itself, which is always the closest, triggers the early request.
+UNCERTAINTYMAP_EARLY_EPHEMERIS_DISTANCE = 0
+
+# Show durations of stages like MPC queries and drawing on the generate page.
+# They are logged and collected either way.
+UNCERTAINTYMAP_SHOW_TIMINGS = False
+
+# Rendered images are named after a hash of their content and reused, least
+# recently used ones are removed once MEDIA_ROOT grows over this many bytes:
+UNCERTAINTYMAP_MEDIA_MAX_SIZE = 512 * 1024 * 1024
+# PNG encoding, unless chosen in the form, one of `bitmap.PNG_PROFILES`:
+UNCERTAINTYMAP_PNG_PROFILE = 'palette'
+# Wider images are shown on the result page as a preview this many pixels
+# wide, rendered separately, None to always show the full image:
+UNCERTAINTYMAP_PREVIEW_WIDTH = 400
+# Width of the image of the whole uncertainty map with the field outlined on
+# it, shown next to the preview, None to not render it:
+UNCERTAINTYMAP_CONTEXT_WIDTH = 400
+
+# Mosaics, fields planned to cover the variants of poorly constrained
+# objects, take at most MAX_TILES fields, and are rendered on this many
+# threads, at most as many as there are CPUs:
+UNCERTAINTYMAP_MOSAIC_MAX_TILES = 25
+UNCERTAINTYMAP_MOSAIC_THREADS = 4
+
+# Let the front-end server send downloaded images: None to stream them from
+# Django, 'x-sendfile' for Apache or lighttpd, or 'x-accel-redirect' for
+# nginx, with MEDIA_ROOT served as an internal location at X_ACCEL_PREFIX.
+UNCERTAINTYMAP_SENDFILE = None
+UNCERTAINTYMAP_X_ACCEL_PREFIX = '/protected-media/'
+
+# Keep images rendered by the generate view in memory, written to MEDIA_ROOT
+# only when downloaded. Memory is per process, so only enable with a single
+# web process, or sticky sessions. Images up to DATA_URI_MAX_SIZE bytes are
+# inlined in the page. Background jobs always write images to MEDIA_ROOT.
+UNCERTAINTYMAP_MEMORY_IMAGES = False
+UNCERTAINTYMAP_MEMORY_IMAGES_MAX_SIZE = 64 * 1024 * 1024
+UNCERTAINTYMAP_DATA_URI_MAX_SIZE = 32 * 1024
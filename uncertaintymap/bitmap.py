@@ -1,13 +1,311 @@
-from contextlib import suppress
-from math import floor
-from typing import List, Tuple, Generator, Union, Optional
+from copy import copy
+from hashlib import sha1
+from math import cos, floor, radians, sin
+from typing import (
+    BinaryIO, List, Tuple, Generator, Union, Optional, Sequence)
 
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
 
-from uncertaintymap.utils import sec2pixel
+from uncertaintymap.source import Offsets
+from uncertaintymap.timing import Timings
+from uncertaintymap.utils import fitting_scale, sec2pixel
 
 
-class Orbmap:
+# "numpy" renders all markers at once, "pil" draws them one by one:
+ENGINES = ('numpy', 'pil')
+DEFAULT_ENGINE = 'numpy'
+
+# "P" images are drawn with indices into a palette of background and
+# category colors, taking a third of the memory of "RGB" ones:
+MODES = ('RGB', 'P')
+
+# "markers" draws every point as a ring of pixels, "density" shades pixels by
+# the number of points on them, for maps with too many to tell apart:
+STYLES = ('markers', 'density')
+DEFAULT_STYLE = 'markers'
+# shades of every category in "density" images, so that they and the
+# background fit a palette of 256 colors:
+DENSITY_LEVELS = 51
+
+# options for saving images as PNG, "palette" ones save 8-bit indexed color
+# images, a fraction of the size of RGB ones:
+PNG_PROFILES = {
+    'default': {'palette': False, 'compress_level': 6},
+    'fast': {'palette': False, 'compress_level': 1},
+    'palette': {'palette': True, 'compress_level': 6},
+    'palette-fast': {'palette': True, 'compress_level': 1},
+}
+DEFAULT_PNG_PROFILE = 'default'
+
+# pixels of a marker around its point, in the order they are drawn:
+MARKER_OFFSETS = (
+    (-1, -1), (+0, -1), (+1, -1), (+1, +0),
+    (+1, +1), (+0, +1), (-1, +1), (-1, +0),
+)
+
+
+def affine(
+        width: int, height: int,
+        angle_seconds_ra: int, angle_seconds_de: int,
+        rotation: float = 0,
+        flip_ra: bool = False, flip_de: bool = False,
+) -> Tuple[float, float, float, float, int, int]:
+    """
+    Transform of offsets from the image center to pixel coordinates, used
+    by `project`.
+
+    :return: coefficients xx, xy, yx, yy, and pixel coordinates of the center
+    """
+    theta = radians(rotation)
+    # rounded, so quarter turns are exact and don't move points on the
+    # boundary between two pixels:
+    rotate = np.round([
+        [cos(theta), sin(theta)],
+        [-sin(theta), cos(theta)],
+    ], 15)
+    scale = np.diag([
+        (-1 if flip_ra else 1) * width / angle_seconds_ra,
+        (-1 if flip_de else 1) * height / angle_seconds_de,
+    ])
+    (xx, xy), (yx, yy) = scale @ rotate
+    # transposing maps x to width - 1 - x, so flip around that pivot:
+    origin_x = width - 1 - floor(width / 2) if flip_ra else floor(width / 2)
+    origin_y = height - 1 - floor(height / 2) if flip_de else floor(height / 2)
+    return xx, xy, yx, yy, origin_x, origin_y
+
+
+def project(
+        points: Offsets,
+        width: int, height: int,
+        angle_seconds_ra: int, angle_seconds_de: int,
+        ra_off_s: int, de_off_s: int,
+        rotation: float = 0,
+        flip_ra: bool = False, flip_de: bool = False,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Translate all points from arcsecond offsets to pixel coordinates at once.
+
+    Offsets from the image center are rotated by `rotation` degrees,
+    counter-clockwise as seen on the image, scaled to pixels, and mirrored
+    for flips, all as a single affine transform. Without rotation and flips,
+    same as calling `sec2pixel` for every point, but vectorized. A flipped
+    coordinate is exactly where a whole-image transpose would move it.
+
+    :return: arrays of x coordinates, y coordinates and category codes
+    """
+    x, y = transform(
+        points.ra.astype(np.int64), points.de.astype(np.int64),
+        ra_off_s, de_off_s,
+        *affine(
+            width, height, angle_seconds_ra, angle_seconds_de,
+            rotation, flip_ra, flip_de))
+    return x, y, points.category
+
+
+def transform(
+        ra: np.ndarray, de: np.ndarray, ra_off_s: int, de_off_s: int,
+        xx: float, xy: float, yx: float, yy: float,
+        origin_x: int, origin_y: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Apply a transform from `affine` to int64 arcsecond offsets, from
+    (`ra_off_s`, `de_off_s`).
+    """
+    d_ra = ra_off_s - ra
+    d_de = de_off_s - de
+    x = np.round(xx * d_ra + xy * d_de)
+    y = np.round(yx * d_ra + yy * d_de)
+    x = x.astype(np.int64) + origin_x
+    y = y.astype(np.int64) + origin_y
+    return x, y
+
+
+def stamp_markers(
+        buffer: np.ndarray, xs: np.ndarray, ys: np.ndarray, colors: np.ndarray,
+):
+    """
+    Draw markers around all points into an image buffer at once.
+
+    Pixels are written in the same order `draw_marker` would write them, so
+    where markers overlap, the later one wins. Pixels outside of the buffer
+    are skipped.
+
+    Writing marker pixel k of point i is write number 8 * i + k, and every
+    pixel gets the color of its last write. A point on the same pixel as a
+    later one is overdrawn by it entirely, so is skipped. The others write
+    every pixel at most once per marker pixel k, so the last writes are
+    found with `np.maximum`, k by k, instead of sorting all marker pixels.
+
+    :param buffer: C-contiguous uint8 array of shape (height, width, 3),
+        or (height, width) for palette indices
+    :param xs: x coordinates of points
+    :param ys: y coordinates of points
+    :param colors: uint8 array of shape (len(xs), 3), or (len(xs),)
+    """
+    h, w = buffer.shape[:2]
+    # points with any of their marker inside:
+    near = np.flatnonzero((xs >= -1) & (xs <= w) & (ys >= -1) & (ys <= h))
+    # of those, the last one on every pixel of the buffer, extended by a
+    # pixel on every side:
+    keys = (ys[near] + 1) * (w + 2) + xs[near] + 1
+    _, last = np.unique(keys[::-1], return_index=True)
+    points = near[len(keys) - 1 - last]
+    xs, ys = xs[points], ys[points]
+    flats, writes = [], []
+    for k, (dx, dy) in enumerate(MARKER_OFFSETS):
+        ring_x, ring_y = xs + dx, ys + dy
+        inside = (ring_x >= 0) & (ring_x < w) & (ring_y >= 0) & (ring_y < h)
+        flats.append((ring_y * w + ring_x)[inside])
+        writes.append(
+            (points[inside] * len(MARKER_OFFSETS) + k).astype(np.int32))
+    flat = np.concatenate(flats)
+    if not len(flat):
+        return
+    # only ever touched where written:
+    last_write = np.empty(h * w, dtype=np.int32)
+    last_write[flat] = -1
+    for ring_flat, ring_writes in zip(flats, writes):
+        last_write[ring_flat] = np.maximum(last_write[ring_flat], ring_writes)
+    # pixels written more than once get the same color every time:
+    winners = last_write[flat] // len(MARKER_OFFSETS)
+    pixels = buffer.reshape(h * w, -1)
+    pixels[flat] = colors[winners].reshape(len(flat), -1)
+
+
+def bin_density(
+        xs: np.ndarray, ys: np.ndarray, codes: np.ndarray,
+        width: int, height: int,
+) -> np.ndarray:
+    """
+    Palette indices of a "density" image of points inside of it.
+
+    Points are counted per pixel and category. A pixel with any points gets
+    the color of the category with most of them, shaded by the number of
+    all of them, on a logarithmic scale up to the largest one. Index 0 is
+    the background, and `1 + code * DENSITY_LEVELS + level` a shade, level 0
+    the faintest.
+
+    :return: uint8 array of shape (height, width)
+    """
+    flat = ys * width + xs
+    total = np.bincount(flat, minlength=height * width)
+    # count categories only on pixels with any points:
+    occupied = np.flatnonzero(total)
+    compact = np.empty(height * width, dtype=np.int64)
+    compact[occupied] = np.arange(len(occupied))
+    categories = len(Offsets.categories)
+    counts = np.bincount(
+        compact[flat] * categories + codes,
+        minlength=len(occupied) * categories,
+    ).reshape(len(occupied), categories)
+    total = total[occupied]
+    scale = (DENSITY_LEVELS - 1) / np.log(max(total.max(initial=0), 2))
+    # a single point gets the faintest shade:
+    levels = np.round(np.log(total) * scale).astype(np.int64)
+    indices = np.zeros(height * width, dtype=np.uint8)
+    indices[occupied] = 1 + counts.argmax(axis=1) * DENSITY_LEVELS + levels
+    return indices.reshape(height, width)
+
+
+def draw_viewports(orbmaps: Sequence['BaseOrbmap']):
+    """
+    Draw images of the same points, like a field and its context, at once.
+
+    Offsets are converted for projecting once, for all images. Images with
+    markers drawn by the "pil" engine are drawn one by one.
+    """
+    for orbmap in orbmaps:
+        if not orbmap.vectorized:
+            orbmap.draw()
+    orbmaps = [orbmap for orbmap in orbmaps if orbmap.vectorized]
+    if not orbmaps:
+        return
+    points = orbmaps[0].points
+    timings = orbmaps[0].timings
+    if any(orbmap.points is not points for orbmap in orbmaps):
+        raise ValueError('Viewports are of different points')
+    with timings.span('project'):
+        ra = points.ra.astype(np.int64)
+        de = points.de.astype(np.int64)
+    for orbmap in orbmaps:
+        with timings.span('project'):
+            codes = points.category
+            culled = orbmap.cull or orbmap.style == 'density'
+            candidates = orbmap.candidates() if culled else None
+            if candidates is None:
+                viewport_ra, viewport_de = ra, de
+            else:
+                viewport_ra, viewport_de = ra[candidates], de[candidates]
+                codes = codes[candidates]
+            xs, ys = transform(
+                viewport_ra, viewport_de,
+                orbmap.center_ra_off, orbmap.center_de_off,
+                *affine(
+                    orbmap.w, orbmap.h, orbmap.ra_s, orbmap.de_s,
+                    orbmap.rotation, orbmap.flip_ra, orbmap.flip_de))
+        with timings.span('draw'):
+            if culled:
+                inside = (
+                    (xs >= 0) & (xs <= orbmap.w - 1)
+                    & (ys >= 0) & (ys <= orbmap.h - 1))
+                xs, ys, codes = xs[inside], ys[inside], codes[inside]
+            buffer = orbmap.rasterize(xs, ys, codes)
+            orbmap.img = Image.frombuffer(
+                orbmap.mode, (orbmap.w, orbmap.h), buffer,
+                'raw', orbmap.mode, 0, 1)
+            if orbmap.mode == 'P':
+                orbmap.img.putpalette(orbmap.flat_palette)
+            orbmap.draw_overlay()
+
+
+def render_key(points: Offsets, *parameters) -> str:
+    """
+    Hash identifying an image rendered from `points` with `parameters`.
+
+    Engines render identical images, so the engine is not a parameter.
+    """
+    key = '{}|{}'.format(points.digest(), '|'.join(map(repr, parameters)))
+    return sha1(key.encode('utf-8')).hexdigest()
+
+
+def to_palette(
+        img: Image.Image, colors: List[Tuple[int, int, int]],
+) -> Image.Image:
+    """
+    Convert an RGB image to a `P` mode image, with `colors` as its palette.
+
+    Only use for images drawn with `colors`, others would be dithered.
+    """
+    palette = Image.new('P', (1, 1))
+    palette.putpalette([value for color in colors for value in color])
+    return img.quantize(palette=palette)
+
+
+def new_buffer(
+        width: int, height: int, bg_color: Union[int, Tuple[int, int, int]],
+) -> np.ndarray:
+    """RGB image buffer, or of palette indices if `bg_color` is an index."""
+    if isinstance(bg_color, int):
+        return np.full((height, width), bg_color, dtype=np.uint8)
+    buffer = np.empty((height, width, 3), dtype=np.uint8)
+    buffer[:, :] = bg_color
+    return buffer
+
+
+class BaseOrbmap:
+    """
+    Image of the variant orbits of an uncertainty map, as seen in a field
+    `angle_seconds_ra` by `angle_seconds_de` arcseconds large, centered
+    `ra_off_s`, `de_off_s` arcseconds from the center of the map.
+
+    Subclasses only differ in parameters. Several images of the same points
+    are drawn fastest together, with `draw_viewports`.
+    """
+
+    # whether to skip points outside of the image, even those with part of
+    # their marker inside:
+    cull = True
 
     def __init__(
             self,
@@ -16,8 +314,13 @@ class Orbmap:
             flip_ra: bool, flip_de: bool,
             angle_seconds_ra: int, angle_seconds_de: int,
             ra_off_s: int, de_off_s: int,
-            points: List[Tuple[int, int, str]],
+            points: Union[Offsets, List[Tuple[int, int, str]]],
             bg_color: Optional[Union[str, Tuple[int, int, int]]],
+            engine: Optional[str] = None,
+            timings: Optional[Timings] = None,
+            png_profile: Optional[str] = None,
+            mode: str = 'RGB',
+            style: Optional[str] = None,
     ):
         self.w = width
         self.h = height
@@ -28,11 +331,27 @@ class Orbmap:
         self.de_s = angle_seconds_de
         self.center_ra_off = ra_off_s
         self.center_de_off = de_off_s
-        self.points = points
+        self.points = Offsets.from_points(points)
         self.bg_color = bg_color
         if self.bg_color is None:
             self.bg_color = 'white'
-        self.img = Image.new('RGB', (self.w, self.h), self.bg_color)
+        if isinstance(self.bg_color, str):
+            self.bg_color = ImageColor.getrgb(self.bg_color)
+        self.engine = engine or DEFAULT_ENGINE
+        if self.engine not in ENGINES:
+            raise ValueError('engine can be one of {}'.format(ENGINES))
+        self.png_profile = png_profile or DEFAULT_PNG_PROFILE
+        if self.png_profile not in PNG_PROFILES:
+            raise ValueError(
+                'png_profile can be one of {}'.format(tuple(PNG_PROFILES)))
+        if mode not in MODES:
+            raise ValueError('mode can be one of {}'.format(MODES))
+        self.mode = mode
+        self.style = style or DEFAULT_STYLE
+        if self.style not in STYLES:
+            raise ValueError('style can be one of {}'.format(STYLES))
+        self.img = None
+        self.timings = timings or Timings()
         self.colors = {
             'green': (46, 111, 22),
             'orange': (235, 106, 45),
@@ -43,6 +362,45 @@ class Orbmap:
                 else (255, 255, 255)),
         }
 
+    @property
+    def palette(self) -> np.ndarray:
+        """Colors of `Offsets.categories`, indexable by category code."""
+        return np.array(
+            [self.colors[name] for name in Offsets.categories], np.uint8)
+
+    @property
+    def palette_colors(self) -> List[Tuple[int, int, int]]:
+        """
+        Background and category colors, palette of `P` mode images. Index
+        of a category color is its category code plus one, or as described
+        in `bin_density` for "density" images.
+        """
+        if self.style == 'density':
+            bg = np.array(self.bg_color)
+            # from a quarter of the way from the background to the full color:
+            shades = np.linspace(0.25, 1, DENSITY_LEVELS)[:, None]
+            return [tuple(self.bg_color)] + [
+                tuple(color)
+                for name in Offsets.categories
+                for color in np.round(
+                    bg + (np.array(self.colors[name]) - bg) * shades
+                ).astype(int).tolist()]
+        return [tuple(self.bg_color)] + [
+            self.colors[name] for name in Offsets.categories]
+
+    def color(self, name: str) -> Union[int, Tuple[int, int, int]]:
+        """Color of a category, or its palette index in `P` mode."""
+        if self.mode != 'P':
+            return self.colors[name]
+        if self.style == 'density':
+            return 1 + Offsets.codes[name] * DENSITY_LEVELS + (
+                DENSITY_LEVELS - 1)
+        return Offsets.codes[name] + 1
+
+    @property
+    def flat_palette(self) -> List[int]:
+        return [value for color in self.palette_colors for value in color]
+
     def sec2pixel(self, arc_s: int, x_or_y: str):
         if x_or_y == 'x':
             return sec2pixel(arc_s, self.w, self.ra_s)
@@ -51,128 +409,292 @@ class Orbmap:
         else:
             raise ValueError('x_or_y can be either "x" or "y"')
 
+    @property
+    def vectorized(self) -> bool:
+        """Whether drawn with numpy, as "density" images always are."""
+        return self.engine == 'numpy' or self.style == 'density'
+
     def draw(self):
-        for point in self.data:
-            self.draw_marker(point)
-        if self.flip_ra:
-            self.img = self.img.transpose(Image.FLIP_LEFT_RIGHT)
-        if self.flip_de:
-            self.img = self.img.transpose(Image.FLIP_TOP_BOTTOM)
+        if self.vectorized:
+            self.draw_all()
+        else:
+            with self.timings.span('project'):
+                points = list(self.data)
+            with self.timings.span('draw'):
+                if self.mode == 'P':
+                    self.img = Image.new('P', (self.w, self.h), 0)
+                    self.img.putpalette(self.flat_palette)
+                else:
+                    self.img = Image.new(
+                        'RGB', (self.w, self.h), self.bg_color)
+                for point in points:
+                    self.draw_marker(point)
+                self.draw_overlay()
+
+    def draw_all(self):
+        """Draw markers for all points in one pass over a numpy buffer."""
+        draw_viewports([self])
+
+    def rasterize(
+            self, xs: np.ndarray, ys: np.ndarray, codes: np.ndarray,
+    ) -> np.ndarray:
+        """Image buffer of projected points, as from `new_buffer`."""
+        if self.style == 'density':
+            indices = bin_density(xs, ys, codes, self.w, self.h)
+            if self.mode == 'P':
+                return indices
+            return np.array(self.palette_colors, np.uint8)[indices]
+        if self.mode == 'P':
+            buffer = new_buffer(self.w, self.h, 0)
+            colors = (codes + 1).astype(np.uint8)
+        else:
+            buffer = new_buffer(self.w, self.h, self.bg_color)
+            colors = self.palette[codes]
+        stamp_markers(buffer, xs, ys, colors)
+        return buffer
+
+    def draw_overlay(self):
+        """Draw over the markers, once they are drawn."""
 
-    def save(self, file_path: str):
-        self.img.save(file_path)
+    def corners(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Arcsecond offsets of the outer corners of the image."""
+        return self.to_offsets(
+            np.array([-0.5, self.w - 0.5, self.w - 0.5, -0.5]),
+            np.array([-0.5, -0.5, self.h - 0.5, self.h - 0.5]))
+
+    def to_offsets(
+            self, x: np.ndarray, y: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Arcsecond offsets of pixel coordinates, inverse of `to_pixels`."""
+        xx, xy, yx, yy, origin_x, origin_y = affine(
+            self.w, self.h, self.ra_s, self.de_s,
+            self.rotation, self.flip_ra, self.flip_de)
+        d_ra, d_de = np.linalg.solve(
+            [[xx, xy], [yx, yy]], [x - origin_x, y - origin_y])
+        return self.center_ra_off - d_ra, self.center_de_off - d_de
+
+    def candidates(self) -> Optional[np.ndarray]:
+        """
+        Indices of points that may be inside the image, found with the
+        spatial index of `points`, or None for all of them.
+
+        The index is built by the first image drawn of freshly parsed
+        points, and stored with them in the `MapCache`.
+        """
+        ra, de = self.corners()
+        # points round to pixels up to half a pixel outside of the corners:
+        margin = max(self.ra_s / self.w, self.de_s / self.h)
+        candidates = self.points.index.query(
+            ra.min() - margin, ra.max() + margin,
+            de.min() - margin, de.max() + margin)
+        # gathering most of the points costs more than projecting all:
+        if len(candidates) > len(self.points) // 2:
+            return None
+        return candidates
+
+    def to_pixels(
+            self, ra: np.ndarray, de: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Unrounded pixel coordinates of arcsecond offsets."""
+        xx, xy, yx, yy, origin_x, origin_y = affine(
+            self.w, self.h, self.ra_s, self.de_s,
+            self.rotation, self.flip_ra, self.flip_de)
+        d_ra = self.center_ra_off - ra
+        d_de = self.center_de_off - de
+        return (
+            xx * d_ra + xy * d_de + origin_x,
+            yx * d_ra + yy * d_de + origin_y)
+
+    def key_parameters(self) -> tuple:
+        """Everything but points that the rendered image depends on."""
+        return (
+            self.w, self.h, self.rotation, self.flip_ra, self.flip_de,
+            self.ra_s, self.de_s, self.center_ra_off, self.center_de_off,
+            tuple(self.bg_color), self.png_profile, self.mode, self.style)
+
+    @property
+    def cache_key(self) -> str:
+        return render_key(
+            self.points, type(self).__name__, *self.key_parameters())
+
+    def preview(self, width: int) -> 'BaseOrbmap':
+        """
+        The same field, `width` pixels wide, to be drawn on its own.
+
+        Drawn at that size, markers stay as large as on the full image,
+        instead of being blurred away by resizing it.
+        """
+        preview = copy(self)
+        preview.w = width
+        preview.h = max(1, round(self.h * width / self.w))
+        preview.img = None
+        return preview
+
+    def moved(self, ra_off_s: int, de_off_s: int) -> 'BaseOrbmap':
+        """The same field, centered elsewhere, to be drawn on its own."""
+        moved = copy(self)
+        moved.center_ra_off = ra_off_s
+        moved.center_de_off = de_off_s
+        moved.img = None
+        return moved
+
+    def save(self, file_path: Union[str, BinaryIO]):
+        """Save as PNG, with options of `png_profile`."""
+        options = PNG_PROFILES[self.png_profile]
+        with self.timings.span('encode'):
+            img = self.img
+            if options['palette'] and img.mode != 'P':
+                img = to_palette(img, self.palette_colors)
+            elif not options['palette'] and img.mode == 'P':
+                img = img.convert('RGB')
+            img.save(
+                file_path, 'PNG', compress_level=options['compress_level'])
 
     def draw_marker(self, point: Tuple[int, int, str]):
         x, y, color_name = point
-        color = self.colors[color_name]
-        with suppress(IndexError):
-            self.img.putpixel((x-1, y-1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x+0, y-1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x+1, y-1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x+1, y+0), color)
-        with suppress(IndexError):
-            self.img.putpixel((x+1, y+1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x+0, y+1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x-1, y+1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x-1, y+0), color)
+        color = self.color(color_name)
+        # Pillow wraps negative coordinates around instead of raising
+        # IndexError, so check the bounds explicitly:
+        for dx, dy in MARKER_OFFSETS:
+            if 0 <= x + dx < self.w and 0 <= y + dy < self.h:
+                self.img.putpixel((x + dx, y + dy), color)
+
+    @property
+    def projected(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Pixel coordinates and category codes of points, only of those
+        inside the image if `cull`.
+        """
+        candidates = self.candidates() if self.cull else None
+        points = self.points if candidates is None else self.points[candidates]
+        xs, ys, codes = project(
+            points, self.w, self.h, self.ra_s, self.de_s,
+            self.center_ra_off, self.center_de_off,
+            self.rotation, self.flip_ra, self.flip_de)
+        if not self.cull:
+            return xs, ys, codes
+        inside = (
+            (xs >= 0) & (xs <= self.w - 1) & (ys >= 0) & (ys <= self.h - 1))
+        return xs[inside], ys[inside], codes[inside]
 
     @property
     def data(self) -> Generator[Tuple[int, int, str], None, None]:
-        off_x = floor(self.w / 2)
-        off_y = floor(self.h / 2)
-        for p in self.points:
-            # TODO calculate with self.rotation
-            x = self.sec2pixel(-p[0] + self.center_ra_off, 'x') + off_x
-            y = self.sec2pixel(-p[1] + self.center_de_off, 'y') + off_y
-            if 0 <= x <= self.w - 1 and 0 <= y <= self.h - 1:
-                yield x, y, p[2]
+        xs, ys, codes = self.projected
+        names = Offsets.categories
+        for x, y, code in zip(xs.tolist(), ys.tolist(), codes.tolist()):
+            yield x, y, names[code]
 
 
-class FullOrbmap:
+class Orbmap(BaseOrbmap):
+    """The observed field."""
+
+
+class FullOrbmap(BaseOrbmap):
+    """
+    Context image of the whole uncertainty map, with the outline of the
+    field of `orbmap` on it, if given, and of any other `fields`, like the
+    tiles of a mosaic.
+    """
+
+    cull = False
+
     def __init__(
             self,
             width: int, height: int,
             rotation: float,
             flip_ra: bool, flip_de: bool,
             angle_seconds_ra: int, angle_seconds_de: int,
-            points: List[Tuple[int, int, str]],
+            points: Union[Offsets, List[Tuple[int, int, str]]],
             bg_color: Optional[Union[str, Tuple[int, int, int]]],
-            orbmap: Orbmap,
+            orbmap: Optional[Orbmap],
+            engine: Optional[str] = None,
+            timings: Optional[Timings] = None,
+            png_profile: Optional[str] = None,
+            mode: str = 'RGB',
+            style: Optional[str] = None,
+            ra_off_s: int = 0, de_off_s: int = 0,
+            fields: Sequence[Orbmap] = (),
     ):
-        self.w = width
-        self.h = height
-        self.rotation = rotation
-        self.flip_ra = flip_ra
-        self.flip_de = flip_de
-        self.ra_s = angle_seconds_ra
-        self.de_s = angle_seconds_de
-        self.points = points
-        self.bg_color = bg_color
+        super().__init__(
+            width=width, height=height,
+            rotation=rotation,
+            flip_ra=flip_ra, flip_de=flip_de,
+            angle_seconds_ra=angle_seconds_ra,
+            angle_seconds_de=angle_seconds_de,
+            ra_off_s=ra_off_s, de_off_s=de_off_s,
+            points=points,
+            bg_color=bg_color,
+            engine=engine,
+            timings=timings,
+            png_profile=png_profile,
+            mode=mode,
+            style=style,
+        )
         self.orbmap = orbmap
-        if self.bg_color is None:
-            self.bg_color = 'white'
-        self.img = Image.new('RGB', (self.w, self.h), self.bg_color)
-        self.colors = {
-            'green': (46, 111, 22),
-            'orange': (235, 106, 45),
-            'red': (229, 32, 39),
-            'blue': (32, 70, 246),
-            'black': (
-                (0, 0, 0) if sum(self.bg_color) > 3 * 128
-                else (255, 255, 255)),
-        }
+        self.fields = tuple(fields)
 
-    def sec2pixel(self, arc_s: int, x_or_y: str):
-        if x_or_y == 'x':
-            return sec2pixel(arc_s, self.w, self.ra_s)
-        elif x_or_y == 'y':
-            return sec2pixel(arc_s, self.h, self.de_s)
-        else:
-            raise ValueError('x_or_y can be either "x" or "y"')
-
-    def draw(self):
-        for point in self.data:
-            self.draw_marker(point)
-        if self.flip_ra:
-            self.img = self.img.transpose(Image.FLIP_LEFT_RIGHT)
-        if self.flip_de:
-            self.img = self.img.transpose(Image.FLIP_TOP_BOTTOM)
-
-    def save(self, file_path: str):
-        self.img.save(file_path)
+    @classmethod
+    def around(
+            cls, orbmap: Orbmap, width: int, height: int,
+            range_ra: Tuple[int, int], range_de: Tuple[int, int],
+            fields: Sequence[Orbmap] = (),
+    ) -> 'FullOrbmap':
+        """
+        Context image of `orbmap`, rotated and flipped like it, and scaled
+        to fit the map, spanning `range_ra` and `range_de`, the field and
+        any other `fields` into `width` by `height` pixels.
+        """
+        xx, xy, yx, yy, _, _ = affine(1, 1, 1, 1, orbmap.rotation)
+        corners = [field.corners() for field in (orbmap,) + tuple(fields)]
+        ra = np.concatenate(
+            [np.repeat(range_ra, 2)] + [ra for ra, _ in corners])
+        de = np.concatenate(
+            [np.tile(range_de, 2)] + [de for _, de in corners])
+        # as seen on the image:
+        x, y = xx * ra + xy * de, yx * ra + yy * de
+        center_x = (x.max() + x.min()) / 2
+        center_y = (y.max() + y.min()) / 2
+        # keep markers on the edges whole:
+        margin = 2
+        scale = fitting_scale(
+            width - 2 * margin, height - 2 * margin,
+            max(x.max() - x.min(), 1), max(y.max() - y.min(), 1))
+        return cls(
+            width=width, height=height,
+            rotation=orbmap.rotation,
+            flip_ra=orbmap.flip_ra, flip_de=orbmap.flip_de,
+            angle_seconds_ra=width / scale, angle_seconds_de=height / scale,
+            points=orbmap.points,
+            bg_color=orbmap.bg_color,
+            orbmap=orbmap,
+            engine=orbmap.engine,
+            timings=orbmap.timings,
+            png_profile=orbmap.png_profile,
+            mode=orbmap.mode,
+            style=orbmap.style,
+            # back to arcsecond offsets, by the inverse of the rotation:
+            ra_off_s=round(xx * center_x + yx * center_y),
+            de_off_s=round(xy * center_x + yy * center_y),
+            fields=fields,
+        )
 
-    def draw_marker(self, point: Tuple[int, int, str]):
-        x, y, color_name = point
-        color = self.colors[color_name]
-        with suppress(IndexError):
-            self.img.putpixel((x-1, y-1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x+0, y-1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x+1, y-1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x+1, y+0), color)
-        with suppress(IndexError):
-            self.img.putpixel((x+1, y+1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x+0, y+1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x-1, y+1), color)
-        with suppress(IndexError):
-            self.img.putpixel((x-1, y+0), color)
+    def draw_overlay(self):
+        """Outline the field of `orbmap` and `fields`."""
+        fields = self.fields if self.orbmap is None else (
+            (self.orbmap,) + self.fields)
+        draw = ImageDraw.Draw(self.img)
+        color = self.color('black')
+        for field in fields:
+            xs, ys = self.to_pixels(*field.corners())
+            # Pillow truncates coordinates:
+            xs = np.round(xs).astype(int).tolist()
+            ys = np.round(ys).astype(int).tolist()
+            draw.polygon(list(zip(xs, ys)), outline=color)
 
-    @property
-    def data(self) -> Generator[Tuple[int, int, str], None, None]:
-        off_x = floor(self.w / 2)
-        off_y = floor(self.h / 2)
-        for p in self.points:
-            # TODO calculate with self.rotation
-            x = self.sec2pixel(-p[0], 'x') + off_x
-            y = self.sec2pixel(-p[1], 'y') + off_y
-            yield x, y, p[2]
+    def key_parameters(self) -> tuple:
+        return (
+            self.w, self.h, self.rotation, self.flip_ra, self.flip_de,
+            self.ra_s, self.de_s, self.center_ra_off, self.center_de_off,
+            tuple(self.bg_color), self.png_profile, self.mode, self.style,
+            self.orbmap.key_parameters() if self.orbmap else None,
+            tuple(field.key_parameters() for field in self.fields))
@@ -1,9 +1,13 @@
 import re
 
 from django import forms
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator
 from django.forms import TextInput
 
+from uncertaintymap.bitmap import DEFAULT_STYLE, PNG_PROFILES, STYLES
+
 
 class DateTimeInput(forms.DateTimeInput):
     input_type = 'datetime-local'
@@ -41,7 +45,10 @@ class AstroAngleField(forms.IntegerField):
     def prepare_value(self, value):
         if value in self.empty_values:
             return None
-        value = self.to_python(value)
+        return self.format_value(self.to_python(value))
+
+    def format_value(self, value: int) -> str:
+        """Format seconds, as `to_python` returns them."""
         hours = value // 3600
         value -= hours * 3600
         minutes = value // 60
@@ -97,3 +104,32 @@ class UncertaintyForm(forms.Form):
     object_name = forms.CharField(max_length=15)
     observatory_code = forms.CharField(max_length=3)
     bg_color = forms.IntegerField(min_value=0, max_value=255)
+    png_profile = forms.ChoiceField(
+        label='PNG encoding',
+        choices=[('', 'as configured')] + [
+            (name, name) for name in PNG_PROFILES],
+        required=False,
+    )
+    style = forms.ChoiceField(
+        label='Rendering',
+        choices=[(name, name) for name in STYLES],
+        initial=DEFAULT_STYLE,
+        required=False,
+    )
+
+
+class MosaicForm(UncertaintyForm):
+    overlap = forms.IntegerField(
+        label='Overlap (%)', min_value=0, max_value=90, initial=10)
+    coverage = forms.IntegerField(
+        label='Coverage (%)', min_value=1, max_value=100, initial=90)
+    max_tiles = forms.IntegerField(
+        label='Max. fields', min_value=1, initial=9)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # bounded by settings as they are now, not when first imported:
+        max_tiles = self.fields['max_tiles']
+        max_tiles.max_value = settings.UNCERTAINTYMAP_MOSAIC_MAX_TILES
+        max_tiles.validators.append(MaxValueValidator(max_tiles.max_value))
+        max_tiles.widget.attrs['max'] = max_tiles.max_value
@@ -0,0 +1,340 @@
+import os
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import perf_counter
+from typing import IO, Callable, List, Sequence, Tuple
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.urls import reverse
+
+from uncertaintymap import metrics
+from uncertaintymap.bitmap import (
+    DEFAULT_STYLE, PNG_PROFILES, BaseOrbmap, FullOrbmap, Orbmap,
+    draw_viewports)
+from uncertaintymap.forms import AstroDeField, AstroRaField
+from uncertaintymap.images import get_image_store
+from uncertaintymap.source import MapCache, MpcUncertaintyMap
+from uncertaintymap.tiling import covered, plan_mosaic
+from uncertaintymap.timing import Timings
+from uncertaintymap.utils import atomic_write, evict_least_recently_used
+
+
+def save_media(file_name: str, write: Callable[[IO], None]) -> str:
+    """
+    Save an image to the media directory with `write(fh)`, first evicting
+    least recently used images to keep all of them, this one too, within
+    `UNCERTAINTYMAP_MEDIA_MAX_SIZE`. An image larger than that on its own
+    is kept until the next one is saved.
+
+    :return: path of the saved image
+    """
+    directory = default_storage.location
+    os.makedirs(directory, exist_ok=True)
+    path = default_storage.path(file_name)
+    # concurrent requests may render the same image, never serve a
+    # partially written one:
+    with atomic_write(path) as fh:
+        write(fh)
+        size = fh.tell()
+        evict_least_recently_used(
+            directory,
+            max(settings.UNCERTAINTYMAP_MEDIA_MAX_SIZE - size, 0),
+            '.png')
+    metrics.media_written_bytes.inc(size)
+    return path
+
+
+class UncertaintyGenerator:
+    """
+    Queries MPC and renders uncertainty map images for one submitted form.
+
+    Used both by the streaming generate view and by background jobs, so
+    errors are raised, and reporting them is up to the caller.
+
+    Images are named after a hash of the offsets and all rendering
+    parameters, so an image already in the media directory is served as is
+    instead of being rendered again. With `in_memory`, images are kept in
+    the `ImageStore` of this process instead, and written to disk only when
+    downloaded.
+
+    Durations of all stages are recorded in `timings`.
+    """
+
+    def __init__(self, cleaned_data: dict, in_memory: bool = False):
+        self.cleaned_data = cleaned_data
+        self.in_memory = in_memory
+        self.timings = Timings()
+        self.source = None
+        self.orb = None
+        self.full_orb = None
+        self.preview_orb = None
+        self.render_key = None
+        self.context_render_key = None
+        self.preview_render_key = None
+        self.image_cached = False
+        self.context_image_cached = False
+        self.tiles = []
+        self.coverage = None
+
+    def query_mpc(self):
+        self.source = MpcUncertaintyMap(
+            object_id=self.cleaned_data['object_name'],
+            julian_date=self.cleaned_data['julian_date'],
+            observatory_code=self.cleaned_data['observatory_code'],
+            cache=MapCache.from_settings(),
+            timings=self.timings,
+        )
+        self.source.load()
+        metrics.map_points.observe(len(self.source.offsets))
+
+    def render_image(self):
+        """
+        Render the field image, a preview if it is wider than
+        `UNCERTAINTYMAP_PREVIEW_WIDTH`, and the context image, unless
+        `UNCERTAINTYMAP_CONTEXT_WIDTH` is None, all drawn together.
+        """
+        self.orb = self._field()
+        self.render_key = self.orb.cache_key
+        images = [(self.orb, self.generated_file_name)]
+        width = settings.UNCERTAINTYMAP_PREVIEW_WIDTH
+        if width and self.orb.w > width:
+            self.preview_orb = self.orb.preview(width)
+            self.preview_render_key = self.preview_orb.cache_key
+            images.append(
+                (self.preview_orb, self.generated_preview_file_name))
+        width = settings.UNCERTAINTYMAP_CONTEXT_WIDTH
+        if width:
+            self.full_orb = self._context(self.orb, width)
+            self.context_render_key = self.full_orb.cache_key
+            images.append((self.full_orb, self.generated_context_file_name))
+        cached = self._render(images)
+        self.image_cached = cached[0]
+        if self.full_orb is not None:
+            self.context_image_cached = cached[-1]
+
+    def render_mosaic(self):
+        """
+        Plan a mosaic of fields covering the variants, as `plan_mosaic`
+        does, and render every tile, with a preview like `render_image`,
+        and a context image outlining all of them, on
+        `UNCERTAINTYMAP_MOSAIC_THREADS` threads.
+        """
+        self.orb = self._field()
+        tiles = plan_mosaic(
+            self.orb,
+            overlap=self.cleaned_data['overlap'] / 100,
+            coverage=self.cleaned_data['coverage'] / 100,
+            max_tiles=self.cleaned_data['max_tiles'],
+        )
+        self.coverage = covered(tiles)
+        images, file_names = [], []
+        width = settings.UNCERTAINTYMAP_PREVIEW_WIDTH
+        for tile in tiles:
+            file_name = preview_file_name = self._file_name(tile.cache_key)
+            images.append((tile, file_name))
+            if width and tile.w > width:
+                preview = tile.preview(width)
+                preview_file_name = self._file_name(
+                    preview.cache_key, '-preview')
+                images.append((preview, preview_file_name))
+            file_names.append((file_name, preview_file_name))
+        width = settings.UNCERTAINTYMAP_CONTEXT_WIDTH
+        if width:
+            self.full_orb = self._context(tiles[0], width, tiles[1:])
+            self.context_render_key = self.full_orb.cache_key
+            images.append((self.full_orb, self.generated_context_file_name))
+        self._render(images, threads=min(
+            settings.UNCERTAINTYMAP_MOSAIC_THREADS, os.cpu_count() or 1))
+        self.tiles = [
+            self._tile(tile, *names) for tile, names in zip(tiles, file_names)]
+
+    @property
+    def mosaic_summary(self) -> str:
+        return '{} fields, {:.0%} of variants'.format(
+            len(self.tiles), self.coverage)
+
+    def _field(self) -> Orbmap:
+        """The field as submitted."""
+        center_ra = self.cleaned_data['center_ra']
+        center_de = self.cleaned_data['center_de']
+        if None in (center_ra, center_de):
+            ra_off, de_off = 0, 0
+        else:
+            ra_off = center_ra - self.source.center_ra_sec
+            de_off = center_de - self.source.center_de_sec
+        return Orbmap(
+            width=self.cleaned_data['image_width'],
+            height=self.cleaned_data['image_height'],
+            rotation=self.cleaned_data['field_rotation'],
+            flip_ra=self.cleaned_data['flip_horizontally'],
+            flip_de=self.cleaned_data['flip_vertically'],
+            angle_seconds_ra=self.cleaned_data['field_width'],
+            angle_seconds_de=self.cleaned_data['field_height'],
+            ra_off_s=ra_off,
+            de_off_s=de_off,
+            points=self.source.offsets,
+            bg_color=(self.cleaned_data['bg_color'],) * 3,
+            timings=self.timings,
+            png_profile=self.png_profile,
+            mode=self.mode,
+            style=self.cleaned_data.get('style') or DEFAULT_STYLE,
+        )
+
+    def _context(
+            self, orbmap: Orbmap, width: int, fields: Sequence[Orbmap] = (),
+    ) -> FullOrbmap:
+        return FullOrbmap.around(
+            orbmap,
+            width=width,
+            height=max(1, round(width * orbmap.h / orbmap.w)),
+            range_ra=self.source.range_ra,
+            range_de=self.source.range_de,
+            fields=fields,
+        )
+
+    def _tile(
+            self, tile: Orbmap, file_name: str, preview_file_name: str,
+    ) -> dict:
+        """Pointing and images of a tile of a mosaic, for templates."""
+        ra = (tile.center_ra_off + self.source.center_ra_sec) % (24 * 3600)
+        de = tile.center_de_off + self.source.center_de_sec
+        xs, _, _ = tile.projected
+        return {
+            'center_ra': AstroRaField().format_value(ra),
+            'center_de': AstroDeField().format_value(de),
+            'variants': len(xs),
+            'generated_file_name': file_name,
+            'generated_file_url': self._url(file_name),
+            'preview_src': self._src(preview_file_name),
+        }
+
+    @property
+    def png_profile(self) -> str:
+        return (
+            self.cleaned_data.get('png_profile')
+            or settings.UNCERTAINTYMAP_PNG_PROFILE)
+
+    @property
+    def mode(self) -> str:
+        """Draw palette images right away, if saved as such."""
+        return 'P' if PNG_PROFILES[self.png_profile]['palette'] else 'RGB'
+
+    def _render(
+            self, images: List[Tuple[BaseOrbmap, str]], threads: int = 1,
+    ) -> List[bool]:
+        """
+        Draw and save images, as (orbmap, file name) pairs, unless already
+        saved. Those to render are drawn together, with `draw_viewports`,
+        split among `threads`. Drawing and PNG encoding mostly run without
+        holding the GIL.
+
+        :return: whether each image was already saved
+        """
+        cached = [self._is_saved(file_name) for _, file_name in images]
+        for is_cached in cached:
+            metrics.render_cache_requests.inc(
+                result='hit' if is_cached else 'miss')
+        missing = [
+            image for image, is_cached in zip(images, cached)
+            if not is_cached]
+        if not missing:
+            return cached
+        start = perf_counter()
+        if len(missing) > 1 and threads > 1:
+            groups = [missing[i::threads] for i in range(threads)]
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(self._draw_and_save, groups))
+        else:
+            self._draw_and_save(missing)
+        largest = max(
+            (orbmap for orbmap, _ in missing),
+            key=lambda orbmap: orbmap.w * orbmap.h)
+        metrics.render_seconds.observe(
+            perf_counter() - start,
+            size=metrics.size_class(largest.w, largest.h))
+        return cached
+
+    def _draw_and_save(self, images: List[Tuple[BaseOrbmap, str]]):
+        draw_viewports([orbmap for orbmap, _ in images])
+        for orbmap, file_name in images:
+            if self.in_memory:
+                image = BytesIO()
+                orbmap.save(image)
+                get_image_store().set(file_name, image.getvalue())
+            else:
+                save_media(file_name, orbmap.save)
+
+    def _is_saved(self, file_name: str) -> bool:
+        if self.in_memory:
+            return get_image_store().get(file_name) is not None
+        try:
+            # mark as recently used:
+            os.utime(default_storage.path(file_name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _file_name(self, render_key: str, suffix: str = '') -> str:
+        return '{object_name}-{key}{suffix}.png'.format(
+            object_name=self.cleaned_data['object_name'],
+            key=render_key[:16],
+            suffix=suffix,
+        )
+
+    @property
+    def generated_file_name(self):
+        return self._file_name(self.render_key)
+
+    @property
+    def generated_file_path(self):
+        return os.path.join(default_storage.location, self.generated_file_name)
+
+    @property
+    def generated_file_url(self):
+        return self._url(self.generated_file_name)
+
+    @property
+    def generated_preview_file_name(self):
+        return self._file_name(self.preview_render_key, '-preview')
+
+    @property
+    def preview_src(self):
+        """Source of the image shown on the result page."""
+        if self.preview_orb is None:
+            return self._src(self.generated_file_name)
+        return self._src(self.generated_preview_file_name)
+
+    @property
+    def generated_context_file_name(self):
+        return self._file_name(self.context_render_key, '-context')
+
+    @property
+    def generated_context_file_path(self):
+        return os.path.join(
+            default_storage.location, self.generated_context_file_name)
+
+    @property
+    def generated_context_file_url(self):
+        return self._url(self.generated_context_file_name)
+
+    @property
+    def context_src(self):
+        if self.full_orb is None:
+            return None
+        return self._src(self.generated_context_file_name)
+
+    def _src(self, file_name: str) -> str:
+        """URL of an image, or the image itself as a data URI if small."""
+        if self.in_memory:
+            image = get_image_store().get(file_name)
+            max_size = settings.UNCERTAINTYMAP_DATA_URI_MAX_SIZE
+            if image is not None and len(image) <= max_size:
+                return 'data:image/png;base64,' + b64encode(image).decode()
+        return self._url(file_name)
+
+    def _url(self, file_name: str) -> str:
+        if self.in_memory:
+            return reverse('image', kwargs={'name': file_name})
+        return default_storage.url(file_name)
@@ -0,0 +1,57 @@
+"""
+In-memory store of rendered images, for serving them without touching disk.
+
+The store is per process, so images are only found by requests handled by
+the process that rendered them.
+"""
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from django.conf import settings
+
+
+class ImageStore:
+    """
+    Encoded images by file name, least recently used ones evicted once all
+    of them take more than `max_size` bytes.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._images.get(name)
+            if data is not None:
+                self._images.move_to_end(name)
+            return data
+
+    def set(self, name: str, data: bytes):
+        with self._lock:
+            old = self._images.pop(name, None)
+            if old is not None:
+                self.size -= len(old)
+            self._images[name] = data
+            self.size += len(data)
+            while self.size > self.max_size and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self.size -= len(evicted)
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            return name in self._images
+
+
+_store = None
+
+
+def get_image_store() -> ImageStore:
+    """Image store of this process, sized by Django settings."""
+    global _store
+    if _store is None:
+        _store = ImageStore(settings.UNCERTAINTYMAP_MEMORY_IMAGES_MAX_SIZE)
+    return _store
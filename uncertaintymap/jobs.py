@@ -0,0 +1,201 @@
+"""
+Background generation jobs, run on a local process pool.
+
+Job state is kept in small JSON files, so any web worker process can report
+on jobs submitted by any other.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import suppress
+from functools import partial
+from traceback import format_exception_only
+from typing import Optional
+from uuid import uuid4
+
+import django
+from django.conf import settings
+
+from uncertaintymap import metrics
+from uncertaintymap.generator import UncertaintyGenerator
+from uncertaintymap.utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+QUERYING = 'querying'
+RENDERING = 'rendering'
+DONE = 'done'
+FAILED = 'failed'
+STATES = QUEUED, QUERYING, RENDERING, DONE
+
+_executor = None
+_executor_pid = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Process pool of this process. Workers are started with
+    `UNCERTAINTYMAP_JOB_START_METHOD`, not forked from a web server thread
+    by default, which could leave them a lock another thread held.
+    """
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.UNCERTAINTYMAP_JOB_WORKERS,
+            mp_context=multiprocessing.get_context(
+                settings.UNCERTAINTYMAP_JOB_START_METHOD),
+            initializer=init_worker)
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def submit_to_pool(func, *args) -> Future:
+    """
+    Run `func(*args)` on the pool, started again if a worker died, like
+    when killed running out of memory, which breaks the whole pool.
+    """
+    global _executor
+    try:
+        return get_executor().submit(func, *args)
+    except BrokenProcessPool:
+        _executor = None
+        return get_executor().submit(func, *args)
+
+
+def init_worker():
+    """
+    Set up Django in a started worker, and forget metrics inherited from
+    the submitting process, if forked from it, which recorded them already,
+    so they aren't merged back to it with the first job.
+    """
+    django.setup()
+    metrics.drain()
+
+
+def status_path(job_id: str) -> str:
+    return os.path.join(settings.UNCERTAINTYMAP_JOBS_DIR, job_id + '.json')
+
+
+def get_status(job_id: str) -> Optional[dict]:
+    try:
+        with open(status_path(job_id)) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def set_status(job_id: str, state: str, **kwargs):
+    status = {
+        'id': job_id,
+        'state': state,
+        'finished': state in (DONE, FAILED),
+        'progress': (
+            STATES.index(state) / (len(STATES) - 1) if state in STATES
+            else 1.0),
+        'updated': time.time(),
+    }
+    status.update(kwargs)
+    # write to a temporary file first, so readers never see partial json:
+    with atomic_write(status_path(job_id), 'w') as fh:
+        json.dump(status, fh)
+
+
+def prune():
+    """Remove state of jobs not updated in `UNCERTAINTYMAP_JOBS_KEEP`."""
+    oldest = time.time() - settings.UNCERTAINTYMAP_JOBS_KEEP
+    with os.scandir(settings.UNCERTAINTYMAP_JOBS_DIR) as it:
+        for dir_entry in it:
+            with suppress(FileNotFoundError):
+                if dir_entry.stat().st_mtime < oldest:
+                    os.remove(dir_entry.path)
+
+
+def submit(cleaned_data: dict, mosaic: bool = False) -> str:
+    """
+    Queue generation of images for a submitted form, of a mosaic if
+    `mosaic`, return job id.
+    """
+    os.makedirs(settings.UNCERTAINTYMAP_JOBS_DIR, exist_ok=True)
+    prune()
+    job_id = uuid4().hex
+    set_status(job_id, QUEUED, object_name=cleaned_data['object_name'])
+    future = submit_to_pool(run_in_worker, job_id, cleaned_data, mosaic)
+    metrics.jobs_active.inc()
+    future.add_done_callback(partial(finished, job_id))
+    return job_id
+
+
+def finished(job_id: str, future):
+    """
+    Add metrics a job recorded in its worker to this process, or mark the
+    job failed, if its worker died before it could.
+    """
+    metrics.jobs_active.dec()
+    error = future.exception()
+    if error is None:
+        metrics.merge(future.result())
+        return
+    logger.error('Job %s failed in its worker: %r', job_id, error)
+    status = get_status(job_id) or {}
+    set_status(
+        job_id, FAILED,
+        object_name=status.get('object_name'),
+        error=''.join(format_exception_only(type(error), error)).strip(),
+    )
+
+
+def run_in_worker(job_id: str, cleaned_data: dict, mosaic: bool) -> dict:
+    run(job_id, cleaned_data, mosaic)
+    return metrics.drain()
+
+
+def run(job_id: str, cleaned_data: dict, mosaic: bool = False):
+    """Generate images for a job, recording its progress. Runs in a worker."""
+    generator = UncertaintyGenerator(cleaned_data)
+    object_name = cleaned_data['object_name']
+    try:
+        set_status(job_id, QUERYING, object_name=object_name)
+        generator.query_mpc()
+        set_status(job_id, RENDERING, object_name=object_name)
+        if mosaic:
+            generator.render_mosaic()
+        else:
+            generator.render_image()
+    except Exception as e:
+        logger.exception('Error during job %s', job_id)
+        set_status(
+            job_id, FAILED,
+            object_name=object_name,
+            error=''.join(format_exception_only(type(e), e)).strip(),
+            timings=generator.timings.spans,
+            # as shown on the generate page:
+            timings_text=str(generator.timings),
+        )
+    else:
+        logger.info('Job %s done: %s', job_id, generator.timings)
+        if mosaic:
+            result = dict(
+                tiles=generator.tiles,
+                summary=generator.mosaic_summary,
+            )
+        else:
+            result = dict(
+                generated_file_name=generator.generated_file_name,
+                generated_file_url=generator.generated_file_url,
+                preview_src=generator.preview_src,
+            )
+        set_status(
+            job_id, DONE,
+            object_name=object_name,
+            context_src=generator.context_src,
+            timings=generator.timings.spans,
+            # as shown on the generate page:
+            timings_text=str(generator.timings),
+            **result
+        )
+    generator.timings.record()
@@ -0,0 +1,217 @@
+import json
+import os
+import platform
+import re
+import tempfile
+from timeit import Timer
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from uncertaintymap import source
+from uncertaintymap.bitmap import (
+    ENGINES, PNG_PROFILES, FullOrbmap, Orbmap, draw_viewports)
+from uncertaintymap.source import (
+    MpcUncertaintyMap, Offsets, fake_content, parse_map)
+from uncertaintymap.tiling import plan_mosaic
+
+
+def parse_lines(content: bytes) -> list:
+    """Line by line parsing, as `MpcUncertaintyMap.load` did before."""
+    url_pattern = re.compile(r' href="([^"]+)"')
+    points = []
+    min_distance2 = float('infinity')
+    in_pre = False
+    for line in content.decode('utf-8').split('\n'):
+        if line.strip().startswith('</pre'):
+            in_pre = False
+        if in_pre:
+            point = MpcUncertaintyMap.parse_point(line)
+            points.append(point)
+            distance2 = point[0] ** 2 + point[1] ** 2
+            if distance2 < min_distance2:
+                try:
+                    url_pattern.findall(line)[0]
+                except IndexError:
+                    pass
+                else:
+                    min_distance2 = distance2
+        if line.strip().startswith('<pre'):
+            in_pre = True
+    return points
+
+
+def load_fake_map() -> MpcUncertaintyMap:
+    fake_requests = source.FAKE_REQUESTS
+    source.FAKE_REQUESTS = True
+    try:
+        uncertainty_map = MpcUncertaintyMap(
+            'I156173', 2458327.646703, 'L01', cache=None)
+        uncertainty_map.load()
+    finally:
+        source.FAKE_REQUESTS = fake_requests
+    return uncertainty_map
+
+
+def resized(offsets: Offsets, count: int) -> Offsets:
+    """
+    `count` offsets, repeating `offsets` shifted a little every time, so
+    repeated points don't all land on the same pixels.
+    """
+    repeats = np.arange(count) // len(offsets)
+    return Offsets(
+        np.resize(offsets.ra, count) + repeats * 7,
+        np.resize(offsets.de, count) + repeats * 5,
+        np.resize(offsets.category, count),
+    )
+
+
+def size(value: str) -> tuple:
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+class Command(BaseCommand):
+    help = (
+        'Time loading, parsing, projecting, drawing and saving of the '
+        'uncertainty map fixture, offline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument(
+            '--number', type=int, default=0,
+            help='Runs per repeat, by default enough to take 0.2 s.')
+        parser.add_argument(
+            '--sizes', type=lambda v: [size(s) for s in v.split(',')],
+            default=[(400, 300), (2048, 2048)],
+            help='Image sizes, like "400x300,2048x2048".')
+        parser.add_argument(
+            '--points', type=lambda v: [int(p) for p in v.split(',')],
+            default=[1000, 10304, 100000],
+            help='Numbers of points, like "1000,100000".')
+        parser.add_argument(
+            '--json', metavar='PATH',
+            help='Write results as JSON to PATH, "-" for standard output.')
+        parser.add_argument(
+            '--baseline', metavar='PATH',
+            help='Compare with results stored earlier with --json.')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.2,
+            help='Slowdown over the baseline reported as a regression.')
+
+    def handle(self, *args, **options):
+        results = {}
+        self.file_sizes = {}
+        for name, func in self.cases(options):
+            number = options['number'] or Timer(func).autorange()[0]
+            times = Timer(func).repeat(options['repeat'], number)
+            results[name] = min(times) / number
+            if options['json'] != '-':
+                self.stdout.write('{:<48}{:>10.2f} ms'.format(
+                    name, results[name] * 1000))
+        if options['json'] != '-':
+            for name, file_size in self.file_sizes.items():
+                self.stdout.write('{:<48}{:>10.1f} kB'.format(
+                    name, file_size / 1024))
+        if options['json']:
+            self.write_json(options['json'], results)
+        if options['baseline']:
+            self.compare(options['baseline'], results, options['tolerance'])
+
+    def cases(self, options):
+        content = fake_content.encode('utf-8')
+        yield 'load', load_fake_map
+        yield 'parse_point per line', lambda: parse_lines(content)
+        yield 'parse_map', lambda: parse_map(content)
+        uncertainty_map = load_fake_map()
+        directory = tempfile.TemporaryDirectory()
+        for width, height in options['sizes']:
+            for count in options['points']:
+                orbmap = Orbmap(
+                    width=width, height=height,
+                    rotation=0,
+                    flip_ra=False, flip_de=False,
+                    angle_seconds_ra=uncertainty_map.full_map_width,
+                    angle_seconds_de=uncertainty_map.full_map_height,
+                    ra_off_s=0, de_off_s=0,
+                    points=resized(uncertainty_map.offsets, count),
+                    bg_color=(0, 0, 0),
+                )
+                case = '{}x{} {} points'.format(width, height, count)
+                yield 'data ' + case, lambda: list(orbmap.data)
+                for engine in ENGINES:
+                    orbmap.engine = engine
+                    yield 'draw {} {}'.format(engine, case), orbmap.draw
+                file_path = os.path.join(directory.name, 'benchmark.png')
+                for profile in PNG_PROFILES:
+                    orbmap.png_profile = profile
+                    name = 'save {} {}'.format(profile, case)
+                    yield name, lambda: orbmap.save(file_path)
+                    # timed by now, the file is left from the last run:
+                    self.file_sizes[name] = os.path.getsize(file_path)
+                orbmap.engine, orbmap.mode = 'numpy', 'P'
+                yield 'draw numpy palette ' + case, orbmap.draw
+                context = FullOrbmap(
+                    width=width, height=height,
+                    rotation=0,
+                    flip_ra=False, flip_de=False,
+                    angle_seconds_ra=uncertainty_map.full_map_width,
+                    angle_seconds_de=uncertainty_map.full_map_height,
+                    points=orbmap.points,
+                    bg_color=(0, 0, 0),
+                    orbmap=orbmap,
+                    mode='P',
+                )
+                yield 'draw field, context ' + case, lambda: (
+                    orbmap.draw(), context.draw())
+                yield 'draw field, context together ' + case, lambda: (
+                    draw_viewports([orbmap, context]))
+                orbmap.style = 'density'
+                yield 'draw density ' + case, orbmap.draw
+                orbmap.style = 'markers'
+                zoomed = Orbmap(
+                    width=width, height=height,
+                    rotation=0,
+                    flip_ra=False, flip_de=False,
+                    angle_seconds_ra=uncertainty_map.full_map_width // 16,
+                    angle_seconds_de=uncertainty_map.full_map_height // 16,
+                    ra_off_s=uncertainty_map.full_map_width // 4,
+                    de_off_s=0,
+                    points=orbmap.points,
+                    bg_color=(0, 0, 0),
+                )
+                yield 'draw zoomed off center ' + case, zoomed.draw
+                yield 'plan mosaic of zoomed ' + case, lambda: plan_mosaic(
+                    zoomed, overlap=0.1, coverage=0.9, max_tiles=25)
+                orbmap.png_profile = 'palette'
+                yield 'save palette from palette ' + case, lambda: (
+                    orbmap.save(file_path))
+        directory.cleanup()
+
+    def write_json(self, path: str, results: dict):
+        document = {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'results': results,
+            'file_sizes': self.file_sizes,
+        }
+        if path == '-':
+            json.dump(document, self.stdout, indent=2, sort_keys=True)
+            self.stdout.write('')
+        else:
+            with open(path, 'w') as fh:
+                json.dump(document, fh, indent=2, sort_keys=True)
+
+    def compare(self, path: str, results: dict, tolerance: float):
+        with open(path) as fh:
+            baseline = json.load(fh)['results']
+        regressions = []
+        for name in sorted(results.keys() & baseline.keys()):
+            ratio = results[name] / baseline[name]
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+            self.stderr.write('{:<48}{:>8.2f}x{}'.format(
+                name, ratio, '  REGRESSION' if ratio > 1 + tolerance else ''))
+        if regressions:
+            raise CommandError('{} of {} cases slower than {}'.format(
+                len(regressions), len(results), path))
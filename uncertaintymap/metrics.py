@@ -0,0 +1,238 @@
+"""
+Operational metrics, exposed in Prometheus text format at `/metrics`.
+
+Metrics are kept per process. Jobs run on a process pool, so a job worker
+`drain`s what it recorded and sends it back with the job result, for the
+submitting process to `merge`.
+"""
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+# upper bounds of histogram buckets of durations, in seconds:
+BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+    float('inf'),
+)
+
+registry = {}  # type: Dict[str, Metric]
+
+
+class Histogram:
+    """Count and sum of observed values, and counts in `buckets`."""
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """Number of values up to each bucket bound, as Prometheus has it."""
+        total = 0
+        result = []
+        with self._lock:
+            for bound, count in zip(self.buckets, self.counts):
+                total += count
+                result.append((bound, total))
+        return result
+
+
+class Metric(ABC):
+    """A metric with one value per combination of label values."""
+
+    type = None
+    drained = True
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+        registry[name] = self
+
+    def key(self, labels: dict) -> Tuple[str, ...]:
+        if labels.keys() != set(self.labels):
+            raise ValueError('{} has labels {}'.format(self.name, self.labels))
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def format_labels(self, key: Tuple[str, ...], **extra) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(name, escape(value)) for name, value in pairs))
+
+    @abstractmethod
+    def expose(self) -> List[str]:
+        """Lines of all values, in Prometheus text format."""
+
+    def drain(self) -> dict:
+        with self._lock:
+            values, self.values = self.values, {}
+        return values
+
+    @abstractmethod
+    def merge(self, values: dict):
+        """Add values taken by `drain` in another process."""
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self) -> List[str]:
+        return [
+            '{}{} {}'.format(self.name, self.format_labels(key), value)
+            for key, value in sorted(self.values.items())]
+
+    def merge(self, values: dict):
+        for key, value in values.items():
+            self.inc(value, **dict(zip(self.labels, key)))
+
+
+class Gauge(Counter):
+    type = 'gauge'
+    # the current state of this process, not something to send elsewhere:
+    drained = False
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class HistogramMetric(Metric):
+    type = 'histogram'
+
+    def __init__(
+            self, name: str, documentation: str, labels=(),
+            buckets: Tuple[float, ...] = BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self._lock:
+            histogram = self.values.setdefault(key, Histogram(self.buckets))
+        histogram.observe(value)
+
+    def expose(self) -> List[str]:
+        lines = []
+        for key, histogram in sorted(self.values.items()):
+            for bound, count in histogram.cumulative():
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    self.format_labels(key, le=format_bound(bound)),
+                    count))
+            lines.append('{}_sum{} {}'.format(
+                self.name, self.format_labels(key), histogram.sum))
+            lines.append('{}_count{} {}'.format(
+                self.name, self.format_labels(key), histogram.count))
+        return lines
+
+    def drain(self) -> dict:
+        return {
+            key: (histogram.counts, histogram.sum)
+            for key, histogram in super().drain().items()}
+
+    def merge(self, values: dict):
+        for key, (counts, total) in values.items():
+            with self._lock:
+                histogram = self.values.setdefault(
+                    key, Histogram(self.buckets))
+            with histogram._lock:
+                for index, count in enumerate(counts):
+                    histogram.counts[index] += count
+                histogram.count += sum(counts)
+                histogram.sum += total
+
+
+def escape(value: str) -> str:
+    return (
+        value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+
+
+def format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def exposition() -> str:
+    """All metrics of this process, in Prometheus text format."""
+    lines = []
+    for name, metric in sorted(registry.items()):
+        lines.append('# HELP {} {}'.format(name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(name, metric.type))
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+def drain() -> dict:
+    """Take all counters and histograms recorded so far, for `merge`."""
+    return {
+        name: metric.drain()
+        for name, metric in registry.items() if metric.drained}
+
+
+def merge(drained: dict):
+    """Add counters and histograms drained in another process."""
+    for name, values in drained.items():
+        registry[name].merge(values)
+
+
+def size_class(width: int, height: int) -> str:
+    """Image size as a coarse label, keeping the number of series small."""
+    megapixels = width * height / 10 ** 6
+    for bound in (0.25, 1, 4, 16):
+        if megapixels <= bound:
+            return '<={}MP'.format(bound)
+    return '>16MP'
+
+
+mpc_requests = Counter(
+    'neowhere_mpc_requests_total',
+    'Requests to minorplanetcenter.net.',
+    labels=('kind', 'outcome'))
+map_cache_requests = Counter(
+    'neowhere_map_cache_requests_total',
+    'Loads of uncertainty maps, by where the map came from.',
+    labels=('result',))
+render_cache_requests = Counter(
+    'neowhere_render_cache_requests_total',
+    'Requested images, by whether they were already rendered.',
+    labels=('result',))
+stage_seconds = HistogramMetric(
+    'neowhere_stage_seconds',
+    'Durations of stages of generating a map.',
+    labels=('stage',))
+render_seconds = HistogramMetric(
+    'neowhere_render_seconds',
+    'Durations of drawing and saving the images of a request, by size of '
+    'the largest one.',
+    labels=('size',))
+map_points = HistogramMetric(
+    'neowhere_map_points',
+    'Numbers of variant orbits in loaded uncertainty maps.',
+    buckets=(100, 1000, 10000, 100000, 1000000, float('inf')))
+media_written_bytes = Counter(
+    'neowhere_media_written_bytes_total',
+    'Bytes of images written to MEDIA_ROOT.')
+generate_streams = Gauge(
+    'neowhere_generate_streams_active',
+    'Generate pages being streamed by this process.')
+jobs_active = Gauge(
+    'neowhere_jobs_active',
+    'Jobs submitted by this process and not finished yet.')
@@ -1,11 +1,554 @@
+import os
 import re
-from typing import Tuple, List
+import threading
+import time
+from array import array
+from collections.abc import Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager, suppress
+from hashlib import sha1
+from math import floor
+from typing import (
+    Any, Callable, Iterator, List, Optional, Tuple, Union)
+from zipfile import BadZipFile
 
+try:
+    import fcntl
+except ImportError:  # not on Windows, files are not locked there
+    fcntl = None
+
+import numpy as np
 import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from uncertaintymap import metrics
+from uncertaintymap.timing import Timings
+from uncertaintymap.utils import atomic_write, evict_least_recently_used
 
 
 FAKE_REQUESTS = False
 
+_session = None
+_session_pid = None
+
+
+def new_session(
+        pool_size: int, retries: int, backoff: float,
+) -> requests.Session:
+    """
+    HTTP session keeping up to `pool_size` connections alive per host, and
+    retrying failed requests with exponential backoff.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(500, 502, 503, 504),
+        # hand the last response to `raise_for_status`, not a RetryError:
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """Process wide session configured in Django settings, for MPC requests."""
+    global _session, _session_pid
+    # pooled sockets must not be shared with forked worker processes:
+    if _session is None or _session_pid != os.getpid():
+        _session = new_session(
+            pool_size=settings.UNCERTAINTYMAP_HTTP_POOL_SIZE,
+            retries=settings.UNCERTAINTYMAP_HTTP_RETRIES,
+            backoff=settings.UNCERTAINTYMAP_HTTP_BACKOFF,
+        )
+        _session_pid = os.getpid()
+    return _session
+
+
+class GridIndex:
+    """
+    Spatial index of offsets, in square cells of a grid over all of them,
+    for finding those in a rectangle without looking at every one.
+
+    Point indices are kept sorted by cell, cell by cell: those in cell
+    `row * columns + column` are `order[starts[cell]:starts[cell + 1]]`.
+    """
+
+    # about as many points per cell, on average over the bounding box:
+    points_per_cell = 8
+
+    def __init__(
+            self,
+            ra_min: int, de_min: int, cell: int, columns: int, rows: int,
+            order: np.ndarray, starts: np.ndarray,
+    ):
+        self.ra_min = ra_min
+        self.de_min = de_min
+        self.cell = cell
+        self.columns = columns
+        self.rows = rows
+        self.order = order
+        self.starts = starts
+
+    @classmethod
+    def build(cls, ra: np.ndarray, de: np.ndarray) -> 'GridIndex':
+        if not len(ra):
+            return cls(0, 0, 1, 1, 1, np.zeros(0, np.int32), np.zeros(2, int))
+        ra_min, de_min = int(ra.min()), int(de.min())
+        width = int(ra.max()) - ra_min + 1
+        height = int(de.max()) - de_min + 1
+        cells = max(len(ra) // cls.points_per_cell, 1)
+        cell = max(int(np.ceil(np.sqrt(width * height / cells))), 1)
+        columns = -(-width // cell)
+        rows = -(-height // cell)
+        cell_ids = (
+            (de.astype(np.int64) - de_min) // cell * columns
+            + (ra.astype(np.int64) - ra_min) // cell)
+        order = np.argsort(cell_ids, kind='mergesort').astype(np.int32)
+        starts = np.searchsorted(
+            cell_ids[order], np.arange(columns * rows + 1))
+        return cls(ra_min, de_min, cell, columns, rows, order, starts)
+
+    def query(
+            self, ra_min: float, ra_max: float, de_min: float, de_max: float,
+    ) -> np.ndarray:
+        """
+        Indices of points in cells overlapping a rectangle, a superset of
+        those inside of it, in their original order.
+        """
+        first_column, last_column = (
+            max(floor((ra - self.ra_min) / self.cell), 0)
+            for ra in (ra_min, ra_max))
+        first_row, last_row = (
+            max(floor((de - self.de_min) / self.cell), 0)
+            for de in (de_min, de_max))
+        last_column = min(last_column, self.columns - 1)
+        last_row = min(last_row, self.rows - 1)
+        if first_column > last_column or first_row > last_row:
+            return np.zeros(0, np.int32)
+        if (first_column, first_row, last_column, last_row) == (
+                0, 0, self.columns - 1, self.rows - 1):
+            return np.arange(len(self.order), dtype=np.int32)
+        # cells of a row are consecutive:
+        indices = np.concatenate([
+            self.order[self.starts[row * self.columns + first_column]:
+                       self.starts[row * self.columns + last_column + 1]]
+            for row in range(first_row, last_row + 1)])
+        indices.sort()
+        return indices
+
+    def dump(self) -> dict:
+        """Arrays of the index, for `MapCache`."""
+        return {
+            'index_grid': np.array([
+                self.ra_min, self.de_min, self.cell, self.columns, self.rows]),
+            'index_order': self.order,
+            'index_starts': self.starts,
+        }
+
+    @classmethod
+    def restore(cls, entry: dict) -> Optional['GridIndex']:
+        if 'index_grid' not in entry:
+            return None
+        return cls(
+            *entry['index_grid'].tolist(),
+            order=entry['index_order'], starts=entry['index_starts'])
+
+
+class Offsets(Sequence):
+    """
+    Columnar store of variant orbit offsets.
+
+    RA and DE offsets in arcseconds are kept in int32 arrays, and colors as
+    uint8 codes into `categories`. Indexing and iterating yields
+    `(ra, de, color)` tuples, built only when accessed, so an `Offsets` can
+    be used wherever a list of such tuples was used before.
+    """
+
+    categories = ('green', 'orange', 'red', 'blue', 'black')
+    codes = {name: code for code, name in enumerate(categories)}
+
+    def __init__(self, ra, de, category, index: Optional[GridIndex] = None):
+        self.ra = np.asarray(ra, dtype=np.int32)
+        self.de = np.asarray(de, dtype=np.int32)
+        self.category = np.asarray(category, dtype=np.uint8)
+        if not len(self.ra) == len(self.de) == len(self.category):
+            raise ValueError('ra, de and category lengths differ')
+        self._index = index
+
+    @property
+    def index(self) -> GridIndex:
+        """`GridIndex` of the offsets, built on first use."""
+        if self._index is None:
+            self._index = GridIndex.build(self.ra, self.de)
+        return self._index
+
+    @classmethod
+    def from_points(
+            cls, points: Union['Offsets', List[Tuple[int, int, str]]],
+    ) -> 'Offsets':
+        if isinstance(points, cls):
+            return points
+        return cls(
+            [p[0] for p in points],
+            [p[1] for p in points],
+            [cls.codes[p[2]] for p in points],
+        )
+
+    def __len__(self) -> int:
+        return len(self.ra)
+
+    def __getitem__(self, index):
+        if isinstance(index, (slice, np.ndarray)):
+            return Offsets(
+                self.ra[index], self.de[index], self.category[index])
+        return (
+            int(self.ra[index]),
+            int(self.de[index]),
+            self.categories[self.category[index]],
+        )
+
+    def __iter__(self) -> Iterator[Tuple[int, int, str]]:
+        names = self.categories
+        return zip(
+            self.ra.tolist(),
+            self.de.tolist(),
+            (names[code] for code in self.category.tolist()),
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.ra.nbytes + self.de.nbytes + self.category.nbytes
+
+    def digest(self) -> str:
+        """Hash of all offsets and colors, equal for equal offsets."""
+        digest = sha1()
+        for column in (self.ra, self.de, self.category):
+            digest.update(np.ascontiguousarray(column).tobytes())
+        return digest.hexdigest()
+
+
+MAP_LINE = re.compile(
+    rb'^ *([+\-]?\d+) +([+\-]?\d+)'  # RA and DE offsets, with sign
+    rb'(?: +<a href="([^"]+)">Ephemeris # *(\d+)</a>)?'  # link, variant no.
+    rb'([^\n]*)$',  # flag, like "!" or "***", if any
+    re.MULTILINE,
+)
+
+
+def flag_category(flag: bytes) -> int:
+    """Category code for the flag at the end of an uncertainty map line."""
+    flag = flag.rstrip()
+    if flag.endswith(b'!!'):
+        color = 'red'
+    elif flag.endswith(b'!'):
+        color = 'orange'
+    elif flag.endswith(b'***'):
+        color = 'black'
+    elif flag.endswith(b'Non-NEO soln'):
+        color = 'blue'
+    else:
+        color = 'green'
+    return Offsets.codes[color]
+
+
+def parse_rows(
+        rows: List[Tuple[bytes, bytes, bytes, bytes, bytes]],
+) -> Tuple[Offsets, np.ndarray, List[bytes]]:
+    """
+    Convert `MAP_LINE` matches to arrays in bulk.
+
+    :return: offsets, variant numbers (0 for lines without an ephemeris
+        link) and ephemeris urls (empty for lines without a link)
+    """
+    if not rows:
+        return Offsets([], [], []), np.zeros(0, np.int32), []
+    ra, de, urls, variants, flags = zip(*rows)
+    flags, inverse = np.unique(flags, return_inverse=True)
+    category = np.array(
+        [flag_category(flag) for flag in flags.tolist()], np.uint8)
+    offsets = Offsets(
+        np.fromiter(map(int, ra), np.int32, len(ra)),
+        np.fromiter(map(int, de), np.int32, len(de)),
+        category[inverse.ravel()],
+    )
+    variants = np.fromiter(
+        map(int, [variant or b'0' for variant in variants]),
+        np.int32, len(variants))
+    return offsets, variants, list(urls)
+
+
+def closest_variant(offsets: Offsets, urls: List[bytes]) -> Optional[int]:
+    """
+    Index of the variant closest to the nominal orbit that has an ephemeris.
+
+    :return: index into `offsets`, or `None` when no variant has a link
+    """
+    has_url = np.fromiter(map(bool, urls), bool, len(urls))
+    if not has_url.any():
+        return None
+    ra = offsets.ra.astype(np.int64)
+    de = offsets.de.astype(np.int64)
+    distance2 = np.where(has_url, ra ** 2 + de ** 2, np.iinfo(np.int64).max)
+    return int(np.argmin(distance2))
+
+
+class MapParser:
+    """
+    Incremental parser of uncertaintymap.cgi responses.
+
+    Fed the raw response in chunks of any size, it parses complete lines of
+    `<pre>` blocks as they arrive with a single compiled regex, and keeps
+    track of the variant with an ephemeris link closest to the nominal
+    orbit, so callers can act on it before the response is fully read.
+
+    Only the current chunk and the parsed columns are held in memory, the
+    columns in growing arrays handed over to `Offsets` without copying.
+    """
+
+    def __init__(self):
+        self.in_pre = False
+        # (ra, de, ephemeris url) of the closest variant so far:
+        self.closest = None
+        self.closest_distance2 = None
+        self._rest = b''
+        self._ra = array('i')
+        self._de = array('i')
+        self._category = array('B')
+        self._variants = array('i')
+
+    def feed(self, data: bytes):
+        first = data.find(b'\n') + 1
+        if not first:
+            self._rest += data
+            return
+        # only the line split between chunks is copied:
+        line = self._rest + data[:first]
+        self._parse(line, 0, len(line))
+        end = data.rfind(b'\n') + 1
+        self._parse(data, first, end)
+        self._rest = data[end:]
+
+    def close(self) -> Tuple[Offsets, np.ndarray]:
+        """
+        :return: offsets and variant numbers (0 for lines without an
+            ephemeris link) of all variants fed
+        """
+        if self._rest:
+            line, self._rest = self._rest + b'\n', b''
+            self._parse(line, 0, len(line))
+        offsets = Offsets(
+            np.frombuffer(self._ra, np.int32) if self._ra else [],
+            np.frombuffer(self._de, np.int32) if self._de else [],
+            np.frombuffer(self._category, np.uint8) if self._category else [],
+        )
+        variants = np.frombuffer(self._variants, np.int32) \
+            if self._variants else np.zeros(0, np.int32)
+        return offsets, variants
+
+    def _parse(self, data: bytes, position: int, end: int):
+        while position < end:
+            if not self.in_pre:
+                start = data.find(b'<pre', position, end)
+                if start == -1:
+                    return
+                position = data.find(b'\n', start, end) + 1
+                self.in_pre = True
+            stop = data.find(b'</pre', position, end)
+            if stop == -1:
+                stop = end
+            else:
+                self.in_pre = False
+            self._add_rows(MAP_LINE.findall(data, position, stop))
+            position = stop
+
+    def _add_rows(self, rows: list):
+        if not rows:
+            return
+        offsets, variants, urls = parse_rows(rows)
+        self._ra.frombytes(offsets.ra.tobytes())
+        self._de.frombytes(offsets.de.tobytes())
+        self._category.frombytes(offsets.category.tobytes())
+        self._variants.frombytes(variants.tobytes())
+        index = closest_variant(offsets, urls)
+        if index is None:
+            return
+        ra, de, _ = offsets[index]
+        distance2 = ra ** 2 + de ** 2
+        if self.closest is None or distance2 < self.closest_distance2:
+            self.closest = ra, de, urls[index].decode('utf-8')
+            self.closest_distance2 = distance2
+
+
+def parse_map(
+        content: bytes,
+) -> Tuple[Offsets, np.ndarray, Optional[Tuple[int, int, str]]]:
+    """
+    Parse variant orbits out of a complete uncertaintymap.cgi response.
+
+    :param content: raw response body
+    :return: offsets, variant numbers (0 for lines without an ephemeris
+        link), and `(ra, de, ephemeris url)` of the variant closest to the
+        nominal orbit, `None` if no variant has an ephemeris link
+    """
+    parser = MapParser()
+    parser.feed(content)
+    offsets, variants = parser.close()
+    return offsets, variants, parser.closest
+
+
+def jd_bucket(julian_date: float, days: float) -> int:
+    """
+    Number of the `days` long period `julian_date` falls in, for maps of
+    dates close enough to share one.
+    """
+    return floor(julian_date / days)
+
+
+class MapCache:
+    """
+    On-disk cache of parsed uncertainty maps, one `.npz` file per entry.
+
+    Entries are keyed on object, Julian date rounded down to `jd_bucket`
+    days and observatory code, so observers at the same site asking for the
+    same object within the bucket share an entry. Entries expire `ttl`
+    seconds after they were stored, and least recently used entries are
+    evicted once files in `directory` grow over `max_size` bytes.
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            ttl: float,
+            max_size: int,
+            jd_bucket: float,
+    ):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.jd_bucket = jd_bucket
+
+    @classmethod
+    def from_settings(cls) -> Optional['MapCache']:
+        """Cache configured in Django settings, `None` if disabled."""
+        if not settings.UNCERTAINTYMAP_CACHE_DIR:
+            return None
+        return cls(
+            directory=settings.UNCERTAINTYMAP_CACHE_DIR,
+            ttl=settings.UNCERTAINTYMAP_CACHE_TTL,
+            max_size=settings.UNCERTAINTYMAP_CACHE_MAX_SIZE,
+            jd_bucket=settings.UNCERTAINTYMAP_CACHE_JD_BUCKET,
+        )
+
+    def key(
+            self, object_id: str, julian_date: float, observatory_code: str,
+    ) -> str:
+        key = '{}|{}|{}'.format(
+            object_id, jd_bucket(julian_date, self.jd_bucket),
+            observatory_code)
+        return sha1(key.encode('utf-8')).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                entry = {name: data[name] for name in data.files}
+            created = float(entry.pop('created'))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, KeyError, BadZipFile):
+            # truncated, or not an entry at all, load the map again:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            return None
+        if time.time() - created > self.ttl:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            return None
+        # mark as recently used:
+        with suppress(FileNotFoundError):
+            os.utime(path)
+        return entry
+
+    def set(self, key: str, entry: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        with atomic_write(self.path(key)) as fh:
+            np.savez(fh, created=time.time(), **entry)
+        self.evict()
+
+    @contextmanager
+    def lock(self, key: str):
+        """
+        Hold an exclusive lock on `key` across processes, so only one of them
+        downloads a map while the others wait for it to appear in the cache.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, key + '.lock'), 'w') as fh:
+            if fcntl is not None:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+            yield
+
+    def evict(self):
+        """
+        Remove least recently used entries until under `max_size`, and lock
+        files older than `ttl`.
+        """
+        evict_least_recently_used(self.directory, self.max_size, '.npz')
+        oldest_lock = time.time() - self.ttl
+        with os.scandir(self.directory) as it:
+            for dir_entry in it:
+                if dir_entry.name.endswith('.lock'):
+                    with suppress(FileNotFoundError):
+                        if dir_entry.stat().st_mtime < oldest_lock:
+                            os.remove(dir_entry.path)
+
+
+class SingleFlight:
+    """
+    Runs a function once for all concurrent callers asking for the same key.
+
+    The first caller runs it, and callers arriving before it returns wait
+    and get the same result, or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: Any, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        :return: result of `func`, and whether it was shared with, rather
+            than computed by, this caller
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            shared = future is not None
+            if not shared:
+                future = self._calls[key] = Future()
+        if shared:
+            return future.result(), True
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+in_flight = SingleFlight()
+
 
 class MpcUncertaintyMap:
 
@@ -24,10 +567,18 @@ class MpcUncertaintyMap:
             object_id: str,
             julian_date: float,
             observatory_code: str,
+            cache: Optional[MapCache] = None,
+            session: Optional[requests.Session] = None,
+            timings: Optional[Timings] = None,
     ):
         self.object_id = object_id
         self.julian_date = julian_date
         self.observatory_code = observatory_code
+        self.cache = cache
+        self.session = session
+        self.timings = timings or Timings()
+        self.from_cache = False
+        self.coalesced = False
         self._offsets = None
         self.closest_ephems_url = None
         self.center_ra_sec = 0
@@ -43,54 +594,148 @@ class MpcUncertaintyMap:
             observatory_code=self.observatory_code,
         )
 
+    def get(self, url: str, **kwargs) -> requests.Response:
+        session = self.session or get_session()
+        kind = 'map' if url == self.url else 'ephemeris'
+        try:
+            response = session.get(
+                url, timeout=settings.UNCERTAINTYMAP_HTTP_TIMEOUT, **kwargs)
+            response.raise_for_status()
+        except requests.Timeout:
+            metrics.mpc_requests.inc(kind=kind, outcome='timeout')
+            raise
+        except requests.HTTPError:
+            metrics.mpc_requests.inc(kind=kind, outcome='http_error')
+            raise
+        except requests.RequestException:
+            metrics.mpc_requests.inc(kind=kind, outcome='error')
+            raise
+        metrics.mpc_requests.inc(kind=kind, outcome='ok')
+        return response
+
     @property
-    def offsets(self) -> List[Tuple[int, int, str]]:
+    def offsets(self) -> Offsets:
         if self._offsets is None:
             self.load()
         return self._offsets
 
     def load(self):
+        """
+        Load the map from cache or MPC. Concurrent loads of the same map,
+        for dates within `UNCERTAINTYMAP_CACHE_JD_BUCKET`, in this process
+        share one download, and with a cache, so do loads in other
+        processes.
+        """
         if self._offsets is not None:
             raise ValueError('offsets not empty')
-        self._offsets = []
-        if FAKE_REQUESTS:
-            content = fake_content
+        if self.cache is None:
+            key = (
+                self.object_id,
+                jd_bucket(
+                    self.julian_date, settings.UNCERTAINTYMAP_CACHE_JD_BUCKET),
+                self.observatory_code,
+            )
         else:
-            response = requests.get(self.url)
-            content = response.content.decode('utf-8')
-        in_pre = False
-        min_distance2 = float('infinity')
-        min_point = None
-        url_pattern = re.compile(r' href="([^"]+)"')
-        min_ephems_url = None
-        for line in content.split('\n'):
-            if line.strip().startswith('</pre'):
-                in_pre = False
-            if in_pre:
-                point = self.parse_point(line)
-                self._update_range(*point[:2])
-                self._offsets.append(point)
-                distance2 = point[0] ** 2 + point[1] ** 2
-                if distance2 < min_distance2:
-                    try:
-                        min_ephems_url = url_pattern.findall(line)[0]
-                    except:
-                        pass
-                    else:
-                        min_distance2 = distance2
-                        min_point = point
-            if line.strip().startswith('<pre'):
-                in_pre = True
-        if not min_ephems_url:
-            raise ValueError('No measurements found')
-        self._load_center(min_point, min_ephems_url)
+            key = self.cache.key(
+                self.object_id, self.julian_date, self.observatory_code)
+        with self.timings.span('load'):
+            entry, self.coalesced = in_flight.do(key, self._load_entry)
+            self._restore(entry)
+        if self.coalesced:
+            metrics.map_cache_requests.inc(result='coalesced')
+        else:
+            metrics.map_cache_requests.inc(
+                result='hit' if self.from_cache else 'miss')
+
+    def _load_entry(self) -> dict:
+        if self.cache is None:
+            self._load_map()
+            return self._dump()
+        key = self.cache.key(
+            self.object_id, self.julian_date, self.observatory_code)
+        entry = self.cache.get(key)
+        if entry is None:
+            with self.cache.lock(key):
+                # another process might have loaded it while we waited:
+                entry = self.cache.get(key)
+                if entry is None:
+                    self._load_map()
+                    entry = self._dump()
+                    self.cache.set(key, entry)
+                    return entry
+        self.from_cache = True
+        return entry
 
-    def _load_center(self, min_point, min_ephems_url):
+    def _dump(self) -> dict:
+        """Parsed state of the map, for `MapCache`."""
+        return dict(
+            self._offsets.index.dump(),
+            ra=self._offsets.ra,
+            de=self._offsets.de,
+            category=self._offsets.category,
+            center=np.array([self.center_ra_sec, self.center_de_sec]),
+            closest_ephems_url=np.array(self.closest_ephems_url),
+        )
+
+    def _restore(self, entry: dict):
+        self._offsets = Offsets(
+            entry['ra'], entry['de'], entry['category'],
+            index=GridIndex.restore(entry))
+        self._update_range(self._offsets.ra, self._offsets.de)
+        self.center_ra_sec, self.center_de_sec = entry['center'].tolist()
+        self.closest_ephems_url = str(entry['closest_ephems_url'])
+
+    def _load_map(self):
+        """
+        Stream the map from MPC, parsing it as it arrives. Once a variant
+        within `UNCERTAINTYMAP_EARLY_EPHEMERIS_DISTANCE` of the nominal
+        orbit shows up, its ephemeris is requested concurrently with the
+        rest of the map. If a closer variant turns up later, its ephemeris
+        is requested after all, so the result is the same either way.
+        """
+        parser = MapParser()
+        early = early_closest = None
+        early_distance2 = settings.UNCERTAINTYMAP_EARLY_EPHEMERIS_DISTANCE ** 2
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            chunks = self.timings.iterate('mpc_map', self._iter_map_chunks())
+            for chunk in chunks:
+                with self.timings.span('parse'):
+                    parser.feed(chunk)
+                if (early is None and parser.closest is not None
+                        and parser.closest_distance2 <= early_distance2):
+                    early_closest = parser.closest
+                    early = executor.submit(
+                        self._get_ephemerides, early_closest[2])
+            with self.timings.span('parse'):
+                self._offsets, _ = parser.close()
+            self._update_range(self._offsets.ra, self._offsets.de)
+            if parser.closest is None:
+                raise ValueError('No measurements found')
+            if parser.closest == early_closest:
+                content = early.result()
+            else:
+                content = self._get_ephemerides(parser.closest[2])
+        min_ra, min_de, self.closest_ephems_url = parser.closest
+        with self.timings.span('center'):
+            self._load_center((min_ra, min_de), content)
+
+    def _iter_map_chunks(self) -> Iterator[bytes]:
+        chunk_size = settings.UNCERTAINTYMAP_HTTP_CHUNK_SIZE
         if FAKE_REQUESTS:
-            content = fake_ephemerides
-        else:
-            response = requests.get(min_ephems_url)
-            content = response.content.decode('utf-8')
+            content = fake_content.encode('utf-8')
+            for start in range(0, len(content), chunk_size):
+                yield content[start:start + chunk_size]
+            return
+        with closing(self.get(self.url, stream=True)) as response:
+            yield from response.iter_content(chunk_size)
+
+    def _get_ephemerides(self, url: str) -> str:
+        with self.timings.span('mpc_ephemeris'):
+            if FAKE_REQUESTS:
+                return fake_ephemerides
+            return self.get(url).content.decode('utf-8')
+
+    def _load_center(self, min_point: Tuple[int, int], content: str):
         in_pre = False
         starts_with_date = re.compile(r'\d{4} \d{2} \d{2} ')
         coords_ra = re.compile(r'^.{17}(.\d{2}) (\d{2}) (\d{2})')
@@ -125,11 +770,13 @@ class MpcUncertaintyMap:
             color = 'green'
         return (*position, color)
 
-    def _update_range(self, ra, de):
-        self.range_ra[0] = min(self.range_ra[0], ra)
-        self.range_de[0] = min(self.range_de[0], de)
-        self.range_ra[1] = max(self.range_ra[1], ra)
-        self.range_de[1] = max(self.range_de[1], de)
+    def _update_range(self, ra: np.ndarray, de: np.ndarray):
+        if not len(ra):
+            return
+        self.range_ra[0] = min(self.range_ra[0], int(ra.min()))
+        self.range_de[0] = min(self.range_de[0], int(de.min()))
+        self.range_ra[1] = max(self.range_ra[1], int(ra.max()))
+        self.range_de[1] = max(self.range_de[1], int(de.max()))
 
     @property
     def full_map_width(self):
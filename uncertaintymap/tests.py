@@ -1,3 +1,1065 @@
-from django.test import TestCase
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import requests
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from uncertaintymap import jobs, metrics
+from uncertaintymap.forms import MosaicForm
+from uncertaintymap.generator import UncertaintyGenerator
+from uncertaintymap.images import ImageStore, get_image_store
+from uncertaintymap.bitmap import (
+    DENSITY_LEVELS, ENGINES, PNG_PROFILES, FullOrbmap, Orbmap,
+    draw_viewports, project)
+from uncertaintymap.management.commands.benchmark import parse_lines
+from uncertaintymap.source import (
+    MapCache,
+    MapParser,
+    MpcUncertaintyMap,
+    Offsets,
+    SingleFlight,
+    fake_content,
+    fake_ephemerides,
+    new_session,
+    parse_map,
+)
+from uncertaintymap.tiling import covered, plan_mosaic
+from uncertaintymap.timing import Timings
+from uncertaintymap.utils import atomic_write
+
+
+def fake_map(**kwargs) -> MpcUncertaintyMap:
+    source = MpcUncertaintyMap(
+        object_id='I156173',
+        julian_date=2458327.646703,
+        observatory_code='L01',
+        **kwargs
+    )
+    with mock.patch('uncertaintymap.source.FAKE_REQUESTS', True):
+        source.load()
+    return source
+
+
+class OffsetsTestCase(SimpleTestCase):
+
+    def test_compatible_with_list_of_tuples(self):
+        points = [(-528, -322, 'green'), (0, 0, 'red'), (15151, 1634, 'black')]
+        offsets = Offsets.from_points(points)
+        self.assertEqual(len(offsets), 3)
+        self.assertEqual(offsets[1], (0, 0, 'red'))
+        self.assertEqual(list(offsets), points)
+        self.assertEqual(list(offsets[1:]), points[1:])
+        self.assertIs(Offsets.from_points(offsets), offsets)
+
+    def test_loaded_from_map(self):
+        source = fake_map()
+        self.assertEqual(len(source.offsets), 10304)
+        self.assertEqual(source.offsets[0], (-528, -322, 'green'))
+        self.assertEqual(source.range_ra, [-647912, 647880])
+        self.assertEqual(source.range_de, [-277284, 18453])
+
+    def test_index(self):
+        offsets = fake_map().offsets
+        for rectangle in [
+                (-5000, 3000, -2000, 1000),
+                (-10 ** 7, -647912, -10 ** 7, 10 ** 7),
+                (10 ** 6, 10 ** 7, 0, 0)]:
+            with self.subTest(rectangle=rectangle):
+                ra_min, ra_max, de_min, de_max = rectangle
+                inside = np.flatnonzero(
+                    (offsets.ra >= ra_min) & (offsets.ra <= ra_max)
+                    & (offsets.de >= de_min) & (offsets.de <= de_max))
+                candidates = offsets.index.query(*rectangle)
+                self.assertTrue((np.diff(candidates) > 0).all())
+                self.assertTrue(np.isin(inside, candidates).all())
+                self.assertLess(len(candidates), len(offsets))
+
+
+class ParseMapTestCase(SimpleTestCase):
+
+    def test_same_as_parse_point(self):
+        content = fake_content.encode('utf-8')
+        offsets, variants, closest = parse_map(content)
+        self.assertEqual(list(offsets), parse_lines(content))
+        self.assertEqual(variants.tolist(), list(range(1, 10305)))
+        self.assertEqual(closest[:2], (0, 0))
+        self.assertIn('VO=04289', closest[2])
+
+    def test_fed_in_chunks(self):
+        content = fake_content.encode('utf-8')
+        parser = MapParser()
+        for start in range(0, len(content), 1000):
+            parser.feed(content[start:start + 1000])
+        offsets, variants = parser.close()
+        expected = parse_map(content)
+        self.assertEqual(list(offsets), list(expected[0]))
+        self.assertEqual(variants.tolist(), expected[1].tolist())
+        self.assertEqual(parser.closest, expected[2])
+
+    def test_streamed_in_bounded_memory(self):
+        content = fake_content.encode('utf-8')
+        chunks = (
+            content[start:start + 16 * 1024]
+            for start in range(0, len(content), 16 * 1024))
+        parser = MapParser()
+        tracemalloc.start()
+        try:
+            for chunk in chunks:
+                parser.feed(chunk)
+            offsets, _ = parser.close()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(len(offsets), 10304)
+        # the whole response is ~2 MB, the parsed columns ~130 kB:
+        self.assertLess(peak, len(content) / 4)
+
+    def test_flags_and_missing_links(self):
+        content = (
+            b'<pre>\n'
+            b'    +10    -20      <a href="a">Ephemeris #    1</a> !!\n'
+            b'     +1     -1\n'
+            b'     +3     +4      <a href="b">Ephemeris #    3</a> ***\n'
+            b'</pre>\n'
+        )
+        offsets, variants, closest = parse_map(content)
+        self.assertEqual(list(offsets), [
+            (10, -20, 'red'), (1, -1, 'green'), (3, 4, 'black')])
+        self.assertEqual(variants.tolist(), [1, 0, 3])
+        self.assertEqual(closest, (3, 4, 'b'))
+
+
+class FakeResponse:
+
+    def __init__(self, session, content):
+        self.session = session
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            self.session.events.append('chunk')
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """Stands in for `requests.Session`, serving the fake MPC responses."""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = []
+        self.events = []
+
+    def get(self, url, **kwargs):
+        self.requests.append((url, kwargs))
+        self.events.append(url)
+        time.sleep(self.delay)
+        if 'uncertaintymap.cgi' in url:
+            return FakeResponse(self, fake_content.encode('utf-8'))
+        else:
+            return FakeResponse(self, fake_ephemerides.encode('utf-8'))
+
+
+class MpcUncertaintyMapTestCase(SimpleTestCase):
+
+    def test_session(self):
+        session = FakeSession()
+        source = MpcUncertaintyMap(
+            'I156173', 2458327.646703, 'L01', session=session)
+        source.load()
+        self.assertEqual(
+            [url for url, _ in session.requests],
+            [source.url, source.closest_ephems_url])
+        self.assertIn('VO=04289', source.closest_ephems_url)
+        for _, kwargs in session.requests:
+            self.assertEqual(
+                kwargs['timeout'], settings.UNCERTAINTYMAP_HTTP_TIMEOUT)
+        self.assertEqual(
+            (source.center_ra_sec, source.center_de_sec), (79395, -8924))
+
+    @override_settings(UNCERTAINTYMAP_HTTP_CHUNK_SIZE=1000)
+    def test_ephemeris_requested_while_map_streams(self):
+        session = FakeSession()
+        source = MpcUncertaintyMap(
+            'I156173', 2458327.646703, 'L01', session=session)
+        source.load()
+        ephemeris_request = session.events.index(source.closest_ephems_url)
+        self.assertIn('chunk', session.events[ephemeris_request:])
+        self.assertEqual(
+            (source.center_ra_sec, source.center_de_sec), (79395, -8924))
+
+    @override_settings(
+        UNCERTAINTYMAP_HTTP_CHUNK_SIZE=1000,
+        UNCERTAINTYMAP_EARLY_EPHEMERIS_DISTANCE=10 ** 6,
+    )
+    def test_early_ephemeris_of_farther_variant_not_used(self):
+        session = FakeSession()
+        source = MpcUncertaintyMap(
+            'I156173', 2458327.646703, 'L01', session=session)
+        source.load()
+        self.assertEqual(len(session.requests), 3)
+        self.assertEqual(session.requests[-1][0], source.closest_ephems_url)
+        self.assertIn('VO=04289', source.closest_ephems_url)
+
+    def test_concurrent_loads_coalesced(self):
+        session = FakeSession(delay=0.2)
+
+        def load(_):
+            source = MpcUncertaintyMap(
+                'I156173', 2458327.646703, 'L01', session=session)
+            source.load()
+            return source
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            sources = list(executor.map(load, range(4)))
+        self.assertEqual(len(session.requests), 2)
+        self.assertEqual(
+            sorted(source.coalesced for source in sources),
+            [False, True, True, True])
+        for source in sources:
+            self.assertEqual(len(source.offsets), 10304)
+            self.assertEqual(source.center_ra_sec, 79395)
+
+    def test_close_dates_coalesced_without_cache(self):
+        session = FakeSession(delay=0.2)
+
+        def load(second):
+            source = MpcUncertaintyMap(
+                'I156173', 2458327.646703 + second / 86400, 'L01',
+                session=session)
+            source.load()
+            return source
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            sources = list(executor.map(load, range(4)))
+        self.assertEqual(len(session.requests), 2)
+        self.assertEqual(
+            sorted(source.coalesced for source in sources),
+            [False, True, True, True])
+
+
+class SingleFlightTestCase(SimpleTestCase):
+
+    def test_exception_shared(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def fail():
+            started.set()
+            release.wait()
+            raise ValueError('No measurements found')
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(single_flight.do, 'key', fail)
+            started.wait()
+            follower = executor.submit(single_flight.do, 'key', fail)
+            time.sleep(0.05)
+            release.set()
+            for future in (leader, follower):
+                with self.assertRaises(ValueError):
+                    future.result()
+        self.assertEqual(single_flight.do('key', lambda: 1), (1, False))
+
+
+class MapCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache = MapCache(
+            self.directory.name, ttl=60, max_size=10 ** 6, jd_bucket=0.01)
+
+    def test_hit(self):
+        loaded = fake_map(cache=self.cache)
+        self.assertFalse(loaded.from_cache)
+        with mock.patch('uncertaintymap.source.MapParser') as parser:
+            cached = fake_map(cache=self.cache)
+        parser.assert_not_called()
+        self.assertTrue(cached.from_cache)
+        self.assertEqual(list(cached.offsets), list(loaded.offsets))
+        self.assertEqual(cached.range_ra, loaded.range_ra)
+        self.assertEqual(
+            (cached.center_ra_sec, cached.center_de_sec),
+            (loaded.center_ra_sec, loaded.center_de_sec))
+        self.assertEqual(cached.closest_ephems_url, loaded.closest_ephems_url)
+        np.testing.assert_array_equal(
+            cached.offsets.index.order, loaded.offsets.index.order)
+
+    def test_key(self):
+        key = self.cache.key('I156173', 2458327.641, 'L01')
+        self.assertEqual(key, self.cache.key('I156173', 2458327.649, 'L01'))
+        self.assertNotEqual(key, self.cache.key('I156173', 2458327.651, 'L01'))
+        self.assertNotEqual(key, self.cache.key('I156173', 2458327.641, 'L02'))
+
+    def test_expired(self):
+        self.cache.set('key', {'x': [1]})
+        self.assertIsNotNone(self.cache.get('key'))
+        self.cache.ttl = -1
+        self.assertIsNone(self.cache.get('key'))
+        self.assertFalse(os.path.exists(self.cache.path('key')))
+
+    def test_corrupt(self):
+        self.cache.set('truncated', {'x': np.arange(1000)})
+        path = self.cache.path('truncated')
+        os.truncate(path, os.path.getsize(path) // 2)
+        np.savez(self.cache.path('foreign'), x=[1])
+        for key in 'truncated', 'foreign':
+            self.assertIsNone(self.cache.get(key))
+            self.assertFalse(os.path.exists(self.cache.path(key)))
+
+    def test_evict_least_recently_used(self):
+        self.cache.set('a', {'x': [0]})
+        self.cache.max_size = 3.5 * os.path.getsize(self.cache.path('a'))
+        for key in 'abc':
+            self.cache.set(key, {'x': [0]})
+            os.utime(self.cache.path(key), (0, 0))
+        self.cache.get('a')
+        self.cache.set('d', {'x': [0]})
+        self.cache.set('e', {'x': [0]})
+        remaining = sorted(os.listdir(self.directory.name))
+        self.assertEqual(remaining, ['a.npz', 'd.npz', 'e.npz'])
+
+
+class AtomicWriteTestCase(SimpleTestCase):
+
+    def test_failed(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'job.json')
+        with atomic_write(path, 'w') as fh:
+            fh.write('written')
+        with self.assertRaises(ValueError):
+            with atomic_write(path, 'w') as fh:
+                fh.write('partial')
+                raise ValueError('not serializable')
+        self.assertEqual(os.listdir(directory.name), ['job.json'])
+        with open(path) as fh:
+            self.assertEqual(fh.read(), 'written')
+
+
+class OrbmapTestCase(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.source = fake_map()
+
+    def orbmap(self, **kwargs) -> Orbmap:
+        params = dict(
+            width=201, height=150,
+            rotation=0,
+            flip_ra=False, flip_de=False,
+            angle_seconds_ra=3000, angle_seconds_de=2000,
+            ra_off_s=0, de_off_s=0,
+            points=self.source.offsets,
+            bg_color=(0, 0, 0),
+        )
+        params.update(kwargs)
+        orbmap = Orbmap(**params)
+        orbmap.draw()
+        return orbmap
+
+    def test_engines_identical(self):
+        for flip_ra in (False, True):
+            for bg_color in ((0, 0, 0), (255, 255, 255)):
+                params = dict(flip_ra=flip_ra, bg_color=bg_color)
+                with self.subTest(**params):
+                    self.assertEqual(
+                        self.orbmap(engine='pil', **params).img.tobytes(),
+                        self.orbmap(engine='numpy', **params).img.tobytes(),
+                    )
+
+    def test_rotation(self):
+        # a point west of the center, right of it in the image:
+        points = Offsets([-100], [0], [0])
+        projected = [
+            project(points, 201, 151, 1000, 1000, 0, 0, rotation)[:2]
+            for rotation in (0, 90, 180, 270)]
+        self.assertEqual(
+            [(int(x[0]), int(y[0])) for x, y in projected],
+            [(120, 75), (100, 60), (80, 75), (100, 90)])
+
+    def test_rotated_half_turn_same_as_flipped(self):
+        # with odd sizes, the center pixel stays in place in both:
+        self.assertEqual(
+            self.orbmap(height=151, rotation=180).img.tobytes(),
+            self.orbmap(height=151, flip_ra=True, flip_de=True).img.tobytes())
+
+    def test_flips_same_as_transposed(self):
+        full_map = dict(
+            angle_seconds_ra=self.source.full_map_width,
+            angle_seconds_de=self.source.full_map_height,
+            orbmap=None)
+        field = dict(
+            angle_seconds_ra=3000, angle_seconds_de=2000,
+            ra_off_s=500, de_off_s=-300)
+        cases = itertools.product(
+            ((FullOrbmap, full_map), (Orbmap, field)),
+            ((200, 150), (201, 151)),
+            ((True, False), (False, True), (True, True)),
+            ('numpy', 'pil'),
+        )
+        for (cls, params), (width, height), (flip_ra, flip_de), engine \
+                in cases:
+            params = dict(
+                params, width=width, height=height, rotation=0,
+                points=self.source.offsets, bg_color=(0, 0, 0),
+                engine=engine)
+            with self.subTest(
+                    cls.__name__, width=width, flip_ra=flip_ra,
+                    flip_de=flip_de, engine=engine):
+                expected = cls(flip_ra=False, flip_de=False, **params)
+                expected.draw()
+                if flip_ra:
+                    expected.img = expected.img.transpose(
+                        Image.FLIP_LEFT_RIGHT)
+                if flip_de:
+                    expected.img = expected.img.transpose(
+                        Image.FLIP_TOP_BOTTOM)
+                orbmap = cls(flip_ra=flip_ra, flip_de=flip_de, **params)
+                orbmap.draw()
+                self.assertEqual(orbmap.img.tobytes(), expected.img.tobytes())
+
+    def test_palette_mode_looks_identical(self):
+        for engine in ENGINES:
+            for bg_color in ((0, 0, 0), (255, 255, 255)):
+                params = dict(engine=engine, bg_color=bg_color)
+                with self.subTest(**params):
+                    orbmap = self.orbmap(mode='P', **params)
+                    self.assertEqual(orbmap.img.mode, 'P')
+                    self.assertEqual(
+                        orbmap.img.convert('RGB').tobytes(),
+                        self.orbmap(**params).img.tobytes(),
+                    )
+
+    def test_preview_drawn_at_its_size(self):
+        orbmap = self.orbmap(width=804, height=600, rotation=30, flip_de=True)
+        preview = orbmap.preview(201)
+        preview.draw()
+        self.assertEqual((preview.w, preview.h), (201, 150))
+        self.assertEqual(
+            preview.img.tobytes(),
+            self.orbmap(rotation=30, flip_de=True).img.tobytes())
+        self.assertNotEqual(preview.cache_key, orbmap.cache_key)
+
+    def test_viewports_drawn_together(self):
+        for mode in ('RGB', 'P'):
+            with self.subTest(mode=mode):
+                field = self.orbmap(
+                    mode=mode, rotation=30, ra_off_s=500, de_off_s=-300)
+                context = FullOrbmap(
+                    width=300, height=200, rotation=30,
+                    flip_ra=True, flip_de=False,
+                    angle_seconds_ra=self.source.full_map_width,
+                    angle_seconds_de=self.source.full_map_height,
+                    points=self.source.offsets, bg_color=(255, 255, 255),
+                    orbmap=field, mode=mode)
+                context.draw()
+                viewports = [
+                    field, context, field.preview(50),
+                    self.orbmap(mode='RGB' if mode == 'P' else 'P')]
+                expected = []
+                for orbmap in viewports:
+                    orbmap.draw()
+                    expected.append(orbmap.img.tobytes())
+                draw_viewports(viewports)
+                self.assertEqual(
+                    [orbmap.img.tobytes() for orbmap in viewports], expected)
+        with self.assertRaises(ValueError):
+            draw_viewports([
+                self.orbmap(), self.orbmap(points=self.source.offsets[1:])])
+
+    def test_corners(self):
+        orbmap = self.orbmap(
+            rotation=30, flip_ra=True, ra_off_s=500, de_off_s=-300)
+        xs, ys = orbmap.to_pixels(*orbmap.corners())
+        np.testing.assert_allclose(xs, [-0.5, 200.5, 200.5, -0.5])
+        np.testing.assert_allclose(ys, [-0.5, -0.5, 149.5, 149.5])
+
+    def test_candidates(self):
+        for params in [
+                dict(),
+                dict(
+                    rotation=30, flip_de=True,
+                    ra_off_s=-2907, de_off_s=-5706),
+                dict(ra_off_s=-400000),
+                dict(angle_seconds_ra=10 ** 7, angle_seconds_de=10 ** 7)]:
+            with self.subTest(**params):
+                orbmap = self.orbmap(**params)
+                xs, ys, codes = project(
+                    self.source.offsets, orbmap.w, orbmap.h,
+                    orbmap.ra_s, orbmap.de_s,
+                    orbmap.center_ra_off, orbmap.center_de_off,
+                    orbmap.rotation, orbmap.flip_ra, orbmap.flip_de)
+                inside = (
+                    (xs >= 0) & (xs <= orbmap.w - 1)
+                    & (ys >= 0) & (ys <= orbmap.h - 1))
+                for expected, actual in zip(
+                        (xs[inside], ys[inside], codes[inside]),
+                        orbmap.projected):
+                    np.testing.assert_array_equal(actual, expected)
+
+    def test_context_around_field(self):
+        field = self.orbmap(
+            angle_seconds_ra=60000, angle_seconds_de=40000,
+            ra_off_s=20000, de_off_s=10000, rotation=30, mode='P')
+        context = FullOrbmap.around(
+            field, 400, 300, self.source.range_ra, self.source.range_de)
+        xs, ys, _ = context.projected
+        self.assertTrue(((xs >= 1) & (xs <= 398)).all())
+        self.assertTrue(((ys >= 1) & (ys <= 298)).all())
+        context.draw()
+        # outlined in the color of "black" points:
+        xs, ys = context.to_pixels(*field.corners())
+        outline = Offsets.codes['black'] + 1
+        for x, y in zip(xs.round(), ys.round()):
+            self.assertEqual(context.img.getpixel((int(x), int(y))), outline)
+
+    def test_density(self):
+        points = Offsets(
+            [0, 0, 0, 0, 40, 40, 1000],
+            [0, 0, 0, 0, 0, 0, 0],
+            [2, 2, 2, 1, 1, 0, 0])
+        for mode in ('RGB', 'P'):
+            with self.subTest(mode=mode):
+                orbmap = self.orbmap(points=points, style='density', mode=mode)
+                palette = orbmap.palette_colors
+                self.assertEqual(len(palette), 256)
+                img = orbmap.img.convert('RGB')
+                # 4 points, the maximum, mostly red:
+                self.assertEqual(
+                    img.getpixel((100, 75)),
+                    palette[1 + 2 * DENSITY_LEVELS + DENSITY_LEVELS - 1])
+                # 2 points, half of the maximum on a log scale, green, the
+                # first of the most common categories:
+                self.assertEqual(
+                    img.getpixel((97, 75)),
+                    palette[1 + (DENSITY_LEVELS - 1) // 2])
+                self.assertEqual(img.getpixel((96, 75)), palette[0])
+                self.assertEqual(
+                    orbmap.img.convert('RGB').tobytes(),
+                    self.orbmap(
+                        points=points, style='density', engine='pil',
+                        mode='RGB' if mode == 'P' else 'P',
+                    ).img.convert('RGB').tobytes())
+        self.assertNotEqual(
+            self.orbmap(points=points, style='density').cache_key,
+            self.orbmap(points=points).cache_key)
+
+    def test_png_profiles_look_identical(self):
+        expected = self.orbmap(bg_color=(90, 90, 90))
+        for profile in PNG_PROFILES:
+            with self.subTest(profile):
+                for mode in ('RGB', 'P'):
+                    orbmap = self.orbmap(
+                        bg_color=(90, 90, 90), png_profile=profile,
+                        mode=mode)
+                    file = io.BytesIO()
+                    orbmap.save(file)
+                    file.seek(0)
+                    saved = Image.open(file)
+                    self.assertEqual(
+                        saved.mode,
+                        'P' if PNG_PROFILES[profile]['palette'] else 'RGB')
+                    self.assertEqual(
+                        saved.convert('RGB').tobytes(),
+                        expected.img.tobytes())
+        with self.assertRaises(ValueError):
+            self.orbmap(png_profile='jpeg')
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            self.orbmap(engine='cairo')
+
+
+class GeneratorTestCase(SimpleTestCase):
+    """Generating images of a submitted form, in a temporary MEDIA_ROOT."""
+
+    cleaned_data = {
+        'image_width': 400,
+        'image_height': 300,
+        'field_width': 6000,
+        'field_height': 4000,
+        'field_rotation': 0,
+        'flip_horizontally': False,
+        'flip_vertically': False,
+        'image_date': '2018-07-28T03:31:00+00:00',
+        'julian_date': 2458327.646528,
+        'center_ra': None,
+        'center_de': None,
+        'object_name': 'I156173',
+        'observatory_code': 'L01',
+        'bg_color': 0,
+    }
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(
+            MEDIA_ROOT=directory.name,
+            UNCERTAINTYMAP_CACHE_DIR=None,
+            UNCERTAINTYMAP_JOBS_DIR=directory.name,
+            SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies',
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def form_data(self, **kwargs) -> dict:
+        """`cleaned_data` as posted with the form."""
+        data = dict(
+            self.cleaned_data,
+            image_date='2018-07-28T03:31:00',
+            center_ra='',
+            center_de='',
+            **kwargs
+        )
+        del data['julian_date']
+        return data
+
+
+@mock.patch('uncertaintymap.source.FAKE_REQUESTS', True)
+class JobsTestCase(GeneratorTestCase):
+
+    def test_run(self):
+        jobs.set_status('job', jobs.QUEUED)
+        response = self.client.get(reverse('job', kwargs={'job_id': 'job'}))
+        self.assertContains(response, 'http-equiv="refresh"')
+        jobs.run('job', self.cleaned_data)
+        response = self.client.get(
+            reverse('job_status', kwargs={'job_id': 'job'}))
+        status = response.json()
+        self.assertEqual(status['state'], jobs.DONE)
+        self.assertEqual(status['progress'], 1)
+        self.assertTrue(os.path.exists(os.path.join(
+            settings.MEDIA_ROOT, status['generated_file_name'])))
+        self.assertTrue(os.path.exists(os.path.join(
+            settings.MEDIA_ROOT, os.path.basename(status['context_src']))))
+        response = self.client.get(reverse('job', kwargs={'job_id': 'job'}))
+        self.assertNotContains(response, 'http-equiv="refresh"')
+        self.assertContains(response, status['generated_file_url'])
+        self.assertContains(response, status['context_src'])
+        self.assertLess(
+            {'load', 'mpc_map', 'parse', 'project', 'draw', 'encode'},
+            status['timings'].keys())
+        self.assertNotContains(response, 'Timings')
+        with self.settings(UNCERTAINTYMAP_SHOW_TIMINGS=True):
+            response = self.client.get(
+                reverse('job', kwargs={'job_id': 'job'}))
+        self.assertContains(response, 'Timings: ' + status['timings_text'])
+
+    def test_rendered_image_reused(self):
+        jobs.run('first', self.cleaned_data)
+        with mock.patch.object(Orbmap, 'draw') as draw:
+            jobs.run('same', dict(self.cleaned_data, image_date='later'))
+        draw.assert_not_called()
+        jobs.run('other', dict(self.cleaned_data, bg_color=255))
+        first, same, other = map(jobs.get_status, ('first', 'same', 'other'))
+        self.assertEqual(same['state'], jobs.DONE)
+        self.assertEqual(
+            same['generated_file_name'], first['generated_file_name'])
+        self.assertNotEqual(
+            other['generated_file_name'], first['generated_file_name'])
+
+    def test_preview(self):
+        jobs.run('job', dict(self.cleaned_data, image_width=1200))
+        status = jobs.get_status('job')
+        self.assertNotEqual(
+            status['preview_src'], status['generated_file_url'])
+        with Image.open(os.path.join(
+                settings.MEDIA_ROOT, os.path.basename(status['preview_src'])
+        )) as preview:
+            self.assertEqual(preview.size, (400, 100))
+        response = self.client.get(reverse('job', kwargs={'job_id': 'job'}))
+        self.assertContains(response, 'src="{}"'.format(status['preview_src']))
+
+    # forked, workers share patched settings and FAKE_REQUESTS:
+    @override_settings(UNCERTAINTYMAP_JOB_START_METHOD='fork')
+    def test_metrics_merged_once(self):
+        metrics.drain()
+        metrics.mpc_requests.inc(kind='map', outcome='timeout')
+        self.addCleanup(setattr, jobs, '_executor', None)
+        jobs.submit(self.cleaned_data)
+        # waits for the job, and for its metrics to be merged:
+        jobs.get_executor().shutdown()
+        self.assertEqual(
+            metrics.mpc_requests.values, {('map', 'timeout'): 1})
+        self.assertEqual(metrics.map_points.values[()].count, 1)
+
+    @override_settings(UNCERTAINTYMAP_JOB_START_METHOD='fork')
+    def test_worker_died(self):
+        self.addCleanup(setattr, jobs, '_executor', None)
+        with mock.patch('uncertaintymap.jobs.run') as run:
+            # in the worker, forked with this mock:
+            run.side_effect = lambda *args: os._exit(1)
+            died = jobs.submit(self.cleaned_data)
+            jobs.get_executor().shutdown()
+        status = jobs.get_status(died)
+        self.assertEqual(status['state'], jobs.FAILED)
+        self.assertIn('BrokenProcessPool', status['error'])
+        done = jobs.submit(self.cleaned_data)
+        jobs.get_executor().shutdown()
+        self.assertEqual(jobs.get_status(done)['state'], jobs.DONE)
+
+    def test_submitted(self):
+        with mock.patch('uncertaintymap.jobs.submit', return_value='job'):
+            response = self.client.post(reverse('form'), self.form_data())
+        self.assertRedirects(
+            response, reverse('job', kwargs={'job_id': 'job'}),
+            fetch_redirect_response=False)
+        # only needed by the generate page:
+        self.assertNotIn('cleaned_data', self.client.session)
+
+    def test_failed(self):
+        with mock.patch('uncertaintymap.source.MapParser.close') as close:
+            close.side_effect = ValueError('No measurements found')
+            jobs.run('job', self.cleaned_data)
+        status = jobs.get_status('job')
+        self.assertEqual(status['state'], jobs.FAILED)
+        self.assertIn('No measurements found', status['error'])
+
+    def test_unknown_job(self):
+        response = self.client.get(
+            reverse('job_status', kwargs={'job_id': 'missing'}))
+        self.assertEqual(response.status_code, 404)
+
+
+class BenchmarkTestCase(SimpleTestCase):
+
+    def test_compared_with_baseline(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'baseline.json')
+        options = dict(
+            repeat=1, number=1, sizes=[(20, 10)], points=[100],
+            stdout=io.StringIO(), stderr=io.StringIO())
+        call_command('benchmark', json=path, **options)
+        with open(path) as fh:
+            results = json.load(fh)['results']
+        self.assertIn('draw numpy 20x10 100 points', results)
+        self.assertIn('load', results)
+        call_command('benchmark', baseline=path, tolerance=1000, **options)
+        with open(path, 'w') as fh:
+            json.dump({'results': dict.fromkeys(results, 1e-9)}, fh)
+        with self.assertRaises(CommandError):
+            call_command('benchmark', baseline=path, **options)
+
+
+class TimingsTestCase(SimpleTestCase):
+
+    def test_spans_add_up(self):
+        timings = Timings()
+        with mock.patch('uncertaintymap.timing.perf_counter') as clock:
+            clock.side_effect = [0, 1, 10, 12, 20, 23, 23, 24]
+            with timings.span('draw'):
+                pass
+            with timings.span('draw'):
+                pass
+            # only waits for items are timed:
+            for _ in timings.iterate('fetch', ['chunk']):
+                pass
+        self.assertEqual(timings.spans, {'draw': 3, 'fetch': 4})
+        self.assertEqual(str(timings), 'draw 3000 ms, fetch 4000 ms')
+
+
+class MetricsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        metrics.drain()
+
+    def test_histogram(self):
+        histogram = metrics.Histogram(buckets=(0.1, 1, float('inf')))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.sum, 5.65)
+        self.assertEqual(
+            histogram.cumulative(), [(0.1, 2), (1, 3), (float('inf'), 4)])
+
+    def test_recorded_while_loading(self):
+        source = MpcUncertaintyMap(
+            'I156173', 2458327.646703, 'L01', session=FakeSession())
+        source.load()
+        source.timings.record()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        content = response.content.decode('utf-8')
+        for line in (
+                'neowhere_mpc_requests_total{kind="map",outcome="ok"} 1',
+                'neowhere_mpc_requests_total{kind="ephemeris",outcome="ok"} 1',
+                'neowhere_map_cache_requests_total{result="miss"} 1',
+                'neowhere_stage_seconds_count{stage="mpc_map"} 1',
+                'neowhere_stage_seconds_bucket{stage="parse",le="+Inf"} 1',
+                '# TYPE neowhere_generate_streams_active gauge',
+        ):
+            self.assertIn(line, content.split('\n'))
+
+    def test_upstream_http_error(self):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_error(503)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        source = MpcUncertaintyMap(
+            'I156173', 2458327.646703, 'L01',
+            session=new_session(pool_size=1, retries=2, backoff=0))
+        with self.assertRaises(requests.HTTPError):
+            source.get('http://127.0.0.1:{}/'.format(server.server_port))
+        self.assertEqual(
+            metrics.mpc_requests.values, {('ephemeris', 'http_error'): 1})
+
+    def test_merged_from_worker(self):
+        metrics.mpc_requests.inc(kind='map', outcome='timeout')
+        metrics.map_points.observe(10304)
+        drained = metrics.drain()
+        self.assertEqual(metrics.mpc_requests.values, {})
+        metrics.merge(drained)
+        metrics.merge(drained)
+        self.assertEqual(
+            metrics.mpc_requests.values, {('map', 'timeout'): 2})
+        self.assertEqual(metrics.map_points.values[()].count, 2)
+
+
+class DownloadTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.content = bytes(range(256)) * 1000
+        with open(os.path.join(directory.name, 'map.png'), 'wb') as fh:
+            fh.write(self.content)
+        self.url = reverse('download', kwargs={'path': 'map.png'})
+
+    def test_streamed(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(
+            response['Content-Disposition'], 'attachment; filename="map.png"')
+        self.assertIn('Last-Modified', response)
+        response = self.client.get(
+            self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('Content-Disposition', response)
+
+    def test_range(self):
+        for header, expected in (
+                ('bytes=10-19', self.content[10:20]),
+                ('bytes=255990-', self.content[255990:]),
+                ('bytes=-5', self.content[-5:]),
+        ):
+            with self.subTest(header):
+                response = self.client.get(self.url, HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(
+                    b''.join(response.streaming_content), expected)
+                self.assertEqual(
+                    response['Content-Length'], str(len(expected)))
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/256000')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=256000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertNotIn('Content-Disposition', response)
+        # invalid, ignored:
+        response = self.client.get(self.url, HTTP_RANGE='bytes=20-10')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        response = self.client.get(
+            self.url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"changed"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_sendfile(self):
+        with self.settings(UNCERTAINTYMAP_SENDFILE='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(
+            response['X-Accel-Redirect'], '/protected-media/map.png')
+        self.assertEqual(response.content, b'')
+        with self.settings(UNCERTAINTYMAP_SENDFILE='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(
+            response['X-Sendfile'],
+            os.path.join(settings.MEDIA_ROOT, 'map.png'))
+
+    def test_missing(self):
+        response = self.client.get(
+            reverse('download', kwargs={'path': 'missing.png'}))
+        self.assertEqual(response.status_code, 404)
+
+
+class ImageStoreTestCase(SimpleTestCase):
+
+    def test_evict_least_recently_used(self):
+        store = ImageStore(max_size=10)
+        store.set('a', b'1234')
+        store.set('b', b'1234')
+        store.get('a')
+        store.set('c', b'1234')
+        self.assertIn('a', store)
+        self.assertNotIn('b', store)
+        self.assertEqual(store.size, 8)
+        # kept even if too large, until the next one comes:
+        store.set('d', b'12345678901')
+        self.assertEqual(store.get('d'), b'12345678901')
+        self.assertNotIn('a', store)
+
+    @mock.patch('uncertaintymap.source.FAKE_REQUESTS', True)
+    def test_rendered_in_memory(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with override_settings(
+                MEDIA_ROOT=directory.name, UNCERTAINTYMAP_CACHE_DIR=None):
+            generator = UncertaintyGenerator(
+                dict(GeneratorTestCase.cleaned_data, bg_color=17),
+                in_memory=True)
+            generator.query_mpc()
+            generator.render_image()
+            name = generator.generated_file_name
+            self.assertEqual(os.listdir(directory.name), [])
+            self.assertTrue(
+                generator.preview_src.startswith('data:image/png'))
+            response = self.client.get(generator.generated_file_url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, get_image_store().get(name))
+            response = self.client.get(
+                reverse('download', kwargs={'path': name}))
+            self.assertEqual(
+                b''.join(response.streaming_content),
+                get_image_store().get(name))
+            self.assertEqual(os.listdir(directory.name), [name])
+
+    @mock.patch('uncertaintymap.source.FAKE_REQUESTS', True)
+    def test_downloads_evicted(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        names = []
+        with override_settings(
+                MEDIA_ROOT=directory.name, UNCERTAINTYMAP_CACHE_DIR=None):
+            for bg_color in 18, 19:
+                generator = UncertaintyGenerator(
+                    dict(GeneratorTestCase.cleaned_data, bg_color=bg_color),
+                    in_memory=True)
+                generator.query_mpc()
+                generator.render_image()
+                names.append(generator.generated_file_name)
+            sizes = [len(get_image_store().get(name)) for name in names]
+            with self.settings(UNCERTAINTYMAP_MEDIA_MAX_SIZE=sum(sizes) - 1):
+                for name in names:
+                    response = self.client.get(
+                        reverse('download', kwargs={'path': name}))
+                    self.assertEqual(response.status_code, 200)
+                    response.close()
+            self.assertEqual(os.listdir(directory.name), names[1:])
+
+
+@mock.patch('uncertaintymap.source.FAKE_REQUESTS', True)
+class MosaicTestCase(GeneratorTestCase):
+
+    def test_plan(self):
+        field = Orbmap(
+            width=200, height=100,
+            rotation=30,
+            flip_ra=True, flip_de=False,
+            angle_seconds_ra=6000, angle_seconds_de=3000,
+            ra_off_s=0, de_off_s=0,
+            points=fake_map().offsets,
+            bg_color=(0, 0, 0),
+        )
+        tiles = plan_mosaic(field, overlap=0.1, coverage=0.9, max_tiles=100)
+        self.assertGreaterEqual(covered(tiles), 0.9)
+        self.assertEqual(
+            (tiles[0].center_ra_off, tiles[0].center_de_off), (0, 0))
+        variants = [len(tile.projected[0]) for tile in tiles]
+        self.assertEqual(variants[0], max(variants))
+        # on a grid of the field, overlapping by a tenth of it:
+        xs, ys = field.to_pixels(
+            np.array([tile.center_ra_off for tile in tiles]),
+            np.array([tile.center_de_off for tile in tiles]))
+        for offsets, step in ((xs - xs[0], 180), (ys - ys[0], 90)):
+            np.testing.assert_allclose(
+                offsets / step, np.round(offsets / step), atol=0.01)
+        capped = plan_mosaic(field, overlap=0.1, coverage=0.9, max_tiles=2)
+        self.assertEqual(
+            [tile.cache_key for tile in capped],
+            [tile.cache_key for tile in tiles[:2]])
+        self.assertLess(covered(capped), 0.9)
+
+    @override_settings(UNCERTAINTYMAP_ASYNC_JOBS=False)
+    def test_view(self):
+        response = self.client.post(
+            reverse('mosaic'),
+            self.form_data(overlap=10, coverage=80, max_tiles=4))
+        self.assertRedirects(
+            response, reverse('mosaic_generate'),
+            fetch_redirect_response=False)
+        # on threads, however many CPUs there are:
+        with mock.patch('os.cpu_count', return_value=4), mock.patch.object(
+                MpcUncertaintyMap, 'load', autospec=True,
+                side_effect=MpcUncertaintyMap.load) as load:
+            response = self.client.get(reverse('mosaic_generate'))
+            content = b''.join(response.streaming_content).decode()
+        load.assert_called_once()
+        self.assertIn('Field 1: RA ', content)
+        self.assertIn('of variants', content)
+        file_names = [
+            name for name in os.listdir(settings.MEDIA_ROOT)
+            if not name.endswith('-context.png')]
+        self.assertEqual(len(file_names), content.count('/download/'))
+        for name in file_names:
+            self.assertIn(name, content)
+
+    def test_job(self):
+        with mock.patch.object(jobs, 'submit', return_value='job') as submit:
+            response = self.client.post(
+                reverse('mosaic'),
+                self.form_data(overlap=10, coverage=80, max_tiles=4))
+        self.assertRedirects(
+            response, reverse('job', kwargs={'job_id': 'job'}),
+            fetch_redirect_response=False)
+        cleaned_data, = submit.call_args[0]
+        self.assertEqual(submit.call_args[1], {'mosaic': True})
+        jobs.run('job', cleaned_data, mosaic=True)
+        status = jobs.get_status('job')
+        self.assertEqual(status['state'], jobs.DONE)
+        response = self.client.get(reverse('job', kwargs={'job_id': 'job'}))
+        self.assertContains(response, status['summary'])
+        self.assertContains(response, 'Field 1: RA ')
+        for tile in status['tiles']:
+            self.assertContains(response, tile['preview_src'])
+
+    def test_max_tiles(self):
+        data = self.form_data(overlap=10, coverage=80, max_tiles=30)
+        self.assertFalse(MosaicForm(data).is_valid())
+        with self.settings(UNCERTAINTYMAP_MOSAIC_MAX_TILES=30):
+            self.assertTrue(MosaicForm(data).is_valid())
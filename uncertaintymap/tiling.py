@@ -0,0 +1,71 @@
+"""
+Mosaics of fields covering the variant orbits of an uncertainty map, for
+poorly constrained objects that don't fit a single field.
+"""
+from typing import List, Sequence
+
+import numpy as np
+
+from uncertaintymap.bitmap import BaseOrbmap
+
+
+def plan_mosaic(
+        field: BaseOrbmap, overlap: float, coverage: float, max_tiles: int,
+) -> List[BaseOrbmap]:
+    """
+    Fields like `field`, moved to cover at least `coverage` of its points,
+    unless that takes more than `max_tiles` of them.
+
+    Tiles are laid on a grid around `field`, aligned with it as seen on the
+    image, and overlapping by `overlap` of its width and height. Every point
+    belongs to the tile of the grid cell it falls in, one step of the grid
+    large, so in the middle of the tile. Tiles with the most points come
+    first, as many as it takes for their points to add up to `coverage`.
+    Points in more tiles than their own, where they overlap, may cover some
+    more.
+
+    :param overlap: fraction of the field, from 0 up to 1
+    :param coverage: fraction of the points, from 0 to 1
+    """
+    points = field.points
+    if not len(points):
+        return [field]
+    x, y = field.to_pixels(points.ra, points.de)
+    center_x, center_y = field.to_pixels(
+        field.center_ra_off, field.center_de_off)
+    step_x, step_y = field.w * (1 - overlap), field.h * (1 - overlap)
+    columns = np.round((x - center_x) / step_x).astype(np.int64)
+    rows = np.round((y - center_y) / step_y).astype(np.int64)
+    first_column, first_row = columns.min(), rows.min()
+    width = columns.max() - first_column + 1
+    cells, counts = np.unique(
+        (rows - first_row) * width + columns - first_column,
+        return_counts=True)
+    # stable, so cells with as many points stay in grid order:
+    order = np.argsort(-counts, kind='mergesort')
+    needed = np.searchsorted(
+        np.cumsum(counts[order]), coverage * len(points)) + 1
+    cells = cells[order[:min(needed, max_tiles)]]
+    ra, de = field.to_offsets(
+        center_x + (cells % width + first_column) * step_x,
+        center_y + (cells // width + first_row) * step_y)
+    return [
+        field.moved(round(tile_ra), round(tile_de))
+        for tile_ra, tile_de in zip(ra.tolist(), de.tolist())]
+
+
+def covered(tiles: Sequence[BaseOrbmap]) -> float:
+    """Fraction of the points of `tiles` inside any of them."""
+    points = tiles[0].points
+    if not len(points):
+        return 1.0
+    inside = np.zeros(len(points), bool)
+    for tile in tiles:
+        candidates = tile.candidates()
+        if candidates is None:
+            candidates = np.arange(len(points))
+        x, y = tile.to_pixels(points.ra[candidates], points.de[candidates])
+        inside[candidates[
+            (x >= -0.5) & (x <= tile.w - 0.5)
+            & (y >= -0.5) & (y <= tile.h - 0.5)]] = True
+    return np.count_nonzero(inside) / len(points)
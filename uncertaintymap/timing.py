@@ -0,0 +1,58 @@
+"""
+Timing of the stages of generating an uncertainty map.
+
+Every request records its own `Timings`, which are logged, and added to the
+`neowhere_stage_seconds` histograms once the request is done.
+"""
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, Iterable, Iterator
+
+from uncertaintymap import metrics
+
+
+class Timings:
+    """
+    Durations of the named stages of one request, in seconds.
+
+    A stage timed more than once, like parsing of every chunk of a map,
+    adds up, also when timed on several threads at once.
+    """
+
+    def __init__(self):
+        self.spans = {}  # type: Dict[str, float]
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0) + seconds
+
+    @contextmanager
+    def span(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start)
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterator:
+        """Yield from `iterable`, timing only the waits for its items."""
+        iterator = iter(iterable)
+        while True:
+            with self.span(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record(self):
+        """Add all stages to `metrics.stage_seconds`."""
+        for name, seconds in self.spans.items():
+            metrics.stage_seconds.observe(seconds, stage=name)
+
+    def __str__(self) -> str:
+        return ', '.join(
+            '{} {:.0f} ms'.format(name, seconds * 1000)
+            for name, seconds in self.spans.items())
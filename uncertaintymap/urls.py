@@ -1,13 +1,33 @@
 from django.urls import path
 
 from uncertaintymap.views import (
+    MetricsView,
+    MosaicFormView,
+    MosaicGenerateView,
     UncertaintyDownloadView,
     UncertaintyFormView,
     UncertaintyGenerateView,
+    UncertaintyImageView,
+    UncertaintyJobStatusView,
+    UncertaintyJobView,
 )
 
 urlpatterns = [
     path('', UncertaintyFormView.as_view(), name="form"),
     path('generate/', UncertaintyGenerateView.as_view(), name="generate"),
+    path('mosaic/', MosaicFormView.as_view(), name="mosaic"),
+    path(
+        'mosaic/generate/',
+        MosaicGenerateView.as_view(),
+        name="mosaic_generate",
+    ),
+    path('jobs/<slug:job_id>/', UncertaintyJobView.as_view(), name="job"),
+    path(
+        'jobs/<slug:job_id>/status',
+        UncertaintyJobStatusView.as_view(),
+        name="job_status",
+    ),
     path('download/<path>', UncertaintyDownloadView.as_view(), name="download"),
+    path('images/<name>', UncertaintyImageView.as_view(), name="image"),
+    path('metrics', MetricsView.as_view(), name="metrics"),
 ]
@@ -1,4 +1,7 @@
-from typing import Tuple
+import os
+import tempfile
+from contextlib import contextmanager, suppress
+from typing import IO, Iterator, Tuple
 
 import jdcal
 from datetime import datetime
@@ -64,3 +67,44 @@ def fitting_scale(
         return frame_h / content_h
     else:
         return frame_w / content_w
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = 'wb') -> Iterator[IO]:
+    """
+    Write `path` through a temporary file next to it, moved over `path`
+    once written, so readers never see a partially written file. If writing
+    fails, the temporary file is removed and `path` is left as it was.
+    """
+    fd, temp_path = tempfile.mkstemp(
+        suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, mode) as fh:
+            yield fh
+        os.replace(temp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+
+
+def evict_least_recently_used(directory: str, max_size: int, suffix: str):
+    """
+    Remove files ending with `suffix` from `directory`, least recently
+    modified first, until the rest of them take at most `max_size` bytes.
+    """
+    entries = []
+    with os.scandir(directory) as it:
+        for dir_entry in it:
+            if dir_entry.name.endswith(suffix):
+                with suppress(FileNotFoundError):
+                    stat = dir_entry.stat()
+                    entries.append(
+                        (stat.st_mtime, stat.st_size, dir_entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        with suppress(FileNotFoundError):
+            os.remove(path)
+        total -= size
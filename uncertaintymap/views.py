@@ -1,24 +1,35 @@
 import logging
 import mimetypes
 import os
+import re
+import stat
 from datetime import datetime
 from traceback import format_exception_only
+from typing import Iterator, Optional, Tuple
+from urllib.parse import quote
 
+from django.conf import settings
 from django.core.files.storage import default_storage
 from django.http import (
+    FileResponse,
+    Http404,
     HttpResponse,
     HttpResponseRedirect,
+    JsonResponse,
     StreamingHttpResponse,
 )
 from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django.views import View
 from django.views.generic import FormView, TemplateView
 
-from uncertaintymap.bitmap import Orbmap, FullOrbmap
-from uncertaintymap.forms import UncertaintyForm
-from uncertaintymap.source import MpcUncertaintyMap
-from uncertaintymap.utils import julian_timestamp, sec2pixel
+from uncertaintymap import jobs, metrics
+from uncertaintymap.forms import MosaicForm, UncertaintyForm
+from uncertaintymap.generator import UncertaintyGenerator, save_media
+from uncertaintymap.images import get_image_store
+from uncertaintymap.utils import julian_timestamp
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +39,11 @@ class UncertaintyFormView(FormView):
     template_name = 'uncertaintymap/form.html'
     success_url = 'generate'
     generated_file_path = None
+    job_id = None
+    # where UncertaintyGenerateView finds the form data:
+    session_key = 'cleaned_data'
+    # whether jobs render a mosaic, see `jobs.run`:
+    mosaic = False
 
     def form_valid(self, form):
         """Form submitted successfully, all fields valid."""
@@ -36,13 +52,21 @@ class UncertaintyFormView(FormView):
         cleaned_data['julian_date'] = julian_timestamp(
             form.cleaned_data['image_date'])
         cleaned_data['image_date'] = cleaned_data['image_date'].isoformat()
-        # save form data so that other pages can access it:
-        self.request.session['cleaned_data'] = cleaned_data
         # save useful form field for next time:
         self.set_initial(cleaned_data)
+        if settings.UNCERTAINTYMAP_ASYNC_JOBS:
+            self.job_id = jobs.submit(cleaned_data, mosaic=self.mosaic)
+        else:
+            # save form data for the generate page:
+            self.request.session[self.session_key] = cleaned_data
         # return a HTTP 302 redirect:
         return super().form_valid(form)
 
+    def get_success_url(self):
+        if self.job_id:
+            return reverse('job', kwargs={'job_id': self.job_id})
+        return super().get_success_url()
+
     def set_initial(self, cleaned_data):
         """Save common fields for future requests."""
         keys = [
@@ -55,6 +79,8 @@ class UncertaintyFormView(FormView):
             'field_width',
             'field_height',
             'bg_color',
+            'png_profile',
+            'style',
         ]
         self.request.session['initial'] = {
             key: cleaned_data[key] for key in keys
@@ -68,29 +94,54 @@ class UncertaintyFormView(FormView):
         return initial
 
 
+class MosaicFormView(UncertaintyFormView):
+    """Form planning several fields to cover the variants."""
+    form_class = MosaicForm
+    template_name = 'uncertaintymap/mosaic.html'
+    session_key = 'mosaic_cleaned_data'
+    mosaic = True
+
+    def get_success_url(self):
+        if self.job_id:
+            return super().get_success_url()
+        return reverse('mosaic_generate')
+
+
 class UncertaintyGenerateView(TemplateView):
     template_name = 'uncertaintymap/generate.html'
+    session_key = 'cleaned_data'
+    form_url_name = 'form'
+    result_template_name = 'uncertaintymap/include/result.html'
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.cleaned_data = None
-        self.source = None
+        self.generator = None
         self.abort = False
-        self.orb = None
-        self.full_orb = None
 
     def get(self, request, *args, **kwargs):
-        self.cleaned_data = self.request.session.get('cleaned_data')
+        self.cleaned_data = self.request.session.get(self.session_key)
         if not self.cleaned_data:
-            return HttpResponseRedirect(reverse('form'))
-        del self.request.session['cleaned_data']
+            return HttpResponseRedirect(reverse(self.form_url_name))
+        del self.request.session[self.session_key]
+        self.generator = UncertaintyGenerator(
+            self.cleaned_data,
+            in_memory=settings.UNCERTAINTYMAP_MEMORY_IMAGES,
+        )
         context = self.get_context_data(**kwargs)
         return StreamingHttpResponse(
             streaming_content=self.render_to_response(context))
 
     def render_to_response(self, context, **response_kwargs):
         response = super().render_to_response(context, **response_kwargs)
-        for line in response.rendered_content.split('\n'):
+        metrics.generate_streams.inc()
+        try:
+            yield from self.render_lines(response.rendered_content)
+        finally:
+            metrics.generate_streams.dec()
+
+    def render_lines(self, content):
+        for line in content.split('\n'):
             if '{requests_status}' in line:
                 line = line.format(requests_status=self.query_mpc())
             if '{pil_status}' in line:
@@ -103,24 +154,34 @@ class UncertaintyGenerateView(TemplateView):
                     result = ''
                 else:
                     result = render_to_string(
-                        'uncertaintymap/include/result.html',
-                        {
-                            'generated_file_url': self.generated_file_url,
-                            'generated_file_name': self.generated_file_name,
-                            'generated_file_path': self.generated_file_path,
-                        },
-                    )
+                        self.result_template_name, self.get_result_context())
                 line = line.format(result=result)
+            if '{timings}' in line:
+                line = line.format(timings=self.report_timings())
             yield line
 
+    def get_result_context(self) -> dict:
+        return {
+            'generated_file_url': self.generator.generated_file_url,
+            'preview_src': self.generator.preview_src,
+            'context_src': self.generator.context_src,
+            'generated_file_name': self.generator.generated_file_name,
+            'generated_file_path': self.generator.generated_file_path,
+        }
+
+    def report_timings(self) -> str:
+        """Log and record durations of all stages, shown if so configured."""
+        timings = self.generator.timings
+        logger.info(
+            'Generated %s: %s', self.cleaned_data['object_name'], timings)
+        timings.record()
+        if not settings.UNCERTAINTYMAP_SHOW_TIMINGS:
+            return ''
+        return '<li>Timings: {}</li>'.format(timings)
+
     def query_mpc(self):
         try:
-            self.source = MpcUncertaintyMap(
-                object_id=self.cleaned_data['object_name'],
-                julian_date=self.cleaned_data['julian_date'],
-                observatory_code=self.cleaned_data['observatory_code'],
-            )
-            self.source.load()
+            self.generator.query_mpc()
         except Exception as e:
             logger.exception('Error during query_mpc')
             self.abort = True
@@ -130,100 +191,190 @@ class UncertaintyGenerateView(TemplateView):
 
     def render_image(self):
         try:
-            center_ra = self.cleaned_data['center_ra']
-            center_de = self.cleaned_data['center_de']
-            if None in (center_ra, center_de):
-                ra_off, de_off = 0, 0
-            else:
-                ra_off = center_ra - self.source.center_ra_sec
-                de_off = center_de - self.source.center_de_sec
-            self.orb = Orbmap(
-                width=self.cleaned_data['image_width'],
-                height=self.cleaned_data['image_height'],
-                rotation=self.cleaned_data['field_rotation'],
-                flip_ra=self.cleaned_data['flip_horizontally'],
-                flip_de=self.cleaned_data['flip_vertically'],
-                angle_seconds_ra=self.cleaned_data['field_width'],
-                angle_seconds_de=self.cleaned_data['field_height'],
-                ra_off_s=ra_off,
-                de_off_s=de_off,
-                points=self.source.offsets,
-                bg_color=(self.cleaned_data['bg_color'],) * 3,
-            )
-            self.orb.draw()
-            self.orb.save(self.generated_file_path)
+            return self.render()
         except Exception as e:
             logger.exception('Error during render_image')
             self.abort = True
             return '<br />'.join(format_exception_only(type(e), e))
-        else:
-            return 'ok'
 
+    def render(self) -> str:
+        self.generator.render_image()
+        return 'cached' if self.generator.image_cached else 'ok'
 
-    def render_context_image(self):
-        try:
-            self.full_orb = FullOrbmap(
-                width=self.cleaned_data['image_width'],
-                height=self.cleaned_data['image_height'],
-                rotation=self.cleaned_data['field_rotation'],
-                flip_ra=self.cleaned_data['flip_horizontally'],
-                flip_de=self.cleaned_data['flip_vertically'],
-                angle_seconds_ra=self.source.full_map_width,
-                angle_seconds_de=self.source.full_map_height,
-                points=self.source.offsets,
-                bg_color=(self.cleaned_data['bg_color'],) * 3,
-                orbmap=self.orb,
-            )
-            self.full_orb.draw()
-            self.full_orb.save(self.generated_context_file_path)
-        except Exception as e:
-            logger.exception('Error during render_context_image')
-            self.abort = True
-            return '<br />'.join(format_exception_only(type(e), e))
-        else:
-            return 'ok'
 
-    @property
-    def generated_file_name(self):
-        return '{object_name}-{iso_datetime}.png'.format(
-            object_name=self.cleaned_data['object_name'],
-            iso_datetime=self.cleaned_data['image_date'].split('.')[0],
-        )
+class MosaicGenerateView(UncertaintyGenerateView):
+    """Render all fields of a mosaic, from a single query to MPC."""
+    session_key = 'mosaic_cleaned_data'
+    form_url_name = 'mosaic'
+    result_template_name = 'uncertaintymap/include/mosaic.html'
 
-    @property
-    def generated_file_path(self):
-        return os.path.join(default_storage.location, self.generated_file_name)
+    def get_result_context(self) -> dict:
+        return {
+            'tiles': self.generator.tiles,
+            'context_src': self.generator.context_src,
+        }
 
-    @property
-    def generated_file_url(self):
-        return default_storage.url(self.generated_file_name)
+    def render(self) -> str:
+        self.generator.render_mosaic()
+        return self.generator.mosaic_summary
 
-    @property
-    def generated_context_file_name(self):
-        return '{object_name}-{iso_datetime}-context.png'.format(
-            object_name=self.cleaned_data['object_name'],
-            iso_datetime=self.cleaned_data['image_date'].split('.')[0],
-        )
 
-    @property
-    def generated_context_file_path(self):
-        return os.path.join(
-            default_storage.location, self.generated_context_file_name)
+class UncertaintyJobView(TemplateView):
+    """Progress of a background job, refreshing itself until finished."""
+    template_name = 'uncertaintymap/job.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['job'] = jobs.get_status(kwargs['job_id'])
+        if context['job'] is None:
+            raise Http404('No such job')
+        context['show_timings'] = settings.UNCERTAINTYMAP_SHOW_TIMINGS
+        return context
+
+
+class UncertaintyJobStatusView(View):
+    def get(self, request, job_id):
+        status = jobs.get_status(job_id)
+        if status is None:
+            raise Http404('No such job')
+        return JsonResponse(status)
+
 
-    @property
-    def generated_context_file_url(self):
-        return default_storage.url(self.generated_context_file_name)
+class UncertaintyImageView(View):
+    """Images rendered into the `ImageStore` of this process."""
+
+    def get(self, request, name):
+        image = get_image_store().get(name)
+        if image is None:
+            raise Http404('No such image')
+        # names are hashes of the content:
+        etag = '"{}"'.format(name)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(image, content_type='image/png')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=86400'
+        return response
+
+
+class MetricsView(View):
+    def get(self, request):
+        return HttpResponse(
+            metrics.exposition(),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 class UncertaintyDownloadView(View):
+    """
+    Serve a generated image as an attachment. The file is streamed in
+    chunks, or handed over to the front-end server to send, as configured
+    with `UNCERTAINTYMAP_SENDFILE`.
+    """
+    chunk_size = 64 * 1024
+
     def get(self, request, path):
         full_path = default_storage.path(path)
-        file_name = os.path.basename(full_path)
-        with open(full_path, 'rb') as fh:
-            response = HttpResponse(fh.read())
-            content_type = mimetypes.guess_type(
-                file_name)[0]  # Use mimetypes to get file type
-            response['content_type'] = content_type
-            response['Content-Disposition'] = "attachment; filename={}".format(
-                file_name)
+        try:
+            file_stat = os.stat(full_path)
+        except FileNotFoundError:
+            # kept only in memory until now:
+            file_stat = self.save_from_memory(path)
+        except OSError:
+            raise Http404('No such image')
+        if not stat.S_ISREG(file_stat.st_mode):
+            raise Http404('No such image')
+        etag = '"{:x}-{:x}"'.format(file_stat.st_mtime_ns, file_stat.st_size)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=int(file_stat.st_mtime))
+        if response is None:
+            response = self.file_response(
+                request, path, full_path, file_stat.st_size, etag)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(file_stat.st_mtime)
+        if response.status_code in (200, 206):
+            response['Content-Disposition'] = (
+                'attachment; filename="{}"'.format(
+                    os.path.basename(full_path)))
+        return response
+
+    @staticmethod
+    def save_from_memory(path: str) -> os.stat_result:
+        image = get_image_store().get(path)
+        if image is None:
+            raise Http404('No such image')
+        return os.stat(save_media(path, lambda fh: fh.write(image)))
+
+    def file_response(
+            self, request, path: str, full_path: str, size: int, etag: str,
+    ) -> HttpResponse:
+        content_type = mimetypes.guess_type(full_path)[0]
+        sendfile = settings.UNCERTAINTYMAP_SENDFILE
+        if sendfile == 'x-sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = full_path
             return response
+        if sendfile == 'x-accel-redirect':
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = (
+                settings.UNCERTAINTYMAP_X_ACCEL_PREFIX + quote(path))
+            return response
+        byte_range = None
+        if request.META.get('HTTP_IF_RANGE', etag) == etag:
+            try:
+                byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */{}'.format(size)
+                return response
+        if byte_range is None:
+            response = FileResponse(
+                open(full_path, 'rb'), content_type=content_type)
+            response['Content-Length'] = size
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                self.read_range(full_path, start, end),
+                status=206, content_type=content_type)
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, end, size)
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    def read_range(
+            self, full_path: str, start: int, end: int,
+    ) -> Iterator[bytes]:
+        with open(full_path, 'rb') as fh:
+            fh.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = fh.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    First and last byte of a single range in a Range header, `None` to send
+    the whole file instead, like for several ranges, or invalid ones.
+
+    :raise ValueError: if the range is not satisfiable
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # suffix range, the last bytes of the file:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        if last and int(last) < start:
+            # invalid, to be ignored (RFC 7233, section 2.1):
+            return None
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size:
+        raise ValueError('Range not satisfiable')
+    return start, end